@@ -1,4 +1,4 @@
-import struct
+import struct, time
 from binascii import *
 
 import numpy as np
@@ -24,15 +24,48 @@ noita_versions = {
 badprng_constget16 = np.float64(-2.147483648e9)
 # 
 badprng_constrand  = np.float64(4.656612875e-10)
+# park-miller, what intmath works out without overflowing
+badprng_multiplier = np.uint64(16807)
+badprng_modulus    = np.uint64(0x7FFFFFFF)
+
+# "numpy" mirrors the game's instructions with numpy scalars, "python" does the same with plain int/float
+badprng_backends = ["numpy", "python"]
+
+# cvttsd2si, out of range doubles come back as the "integer indefinite" 0x80000000
+def cvttsd2si(f):
+    i = int(f)
+    if i < -0x80000000 or i > 0x7FFFFFFF:
+        return -0x80000000
+    return i
+
+def wrap_int32(i):
+    return ((i + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+# ver -> (default_key, bytes_iv_negone, bytes_iv_one), they never change for a version so work them out once per process
+badprng_key_cache = {}
 
 # keys / IVs are generated by the PRNG, and the PRNG needs to be versioned, so let's class it out
 class BadPRNG():
-    def __init__(self, ver):
+    def __init__(self, ver, backend="numpy"):
         self.ver = ver
-        # key used for wak header and referenced all over the place
-        self.default_key     = self.badprng_get16(0x165EC8F)
-        self.bytes_iv_negone = self.badprng_get16((0x165EC8F+0x7FFFFFFE) & 0xFFFFFFFF) # v1 - f2 3a d6 90 da ac b7 e0-2b 0c b5 ba 83 b7 31 c4 
-        self.bytes_iv_one    = self.badprng_get16(0x165EC8F+1)
+        self.backend = backend
+        if backend == "python":
+            self.badprng_intmath   = self.badprng_intmath_py
+            self.badprng_floatmath = self.badprng_floatmath_py
+            self.badprng_nextfloat = self.badprng_nextfloat_py
+            self.badprng_init      = self.badprng_init_py
+            self.badprng_get16     = self.badprng_get16_py
+        elif backend != "numpy":
+            raise ValueError("unknown BadPRNG backend {}, expected one of {}".format(backend, badprng_backends))
+
+        if ver not in badprng_key_cache:
+            badprng_key_cache[ver] = (
+                # key used for wak header and referenced all over the place
+                self.badprng_get16(0x165EC8F),
+                self.badprng_get16((0x165EC8F+0x7FFFFFFE) & 0xFFFFFFFF), # v1 - f2 3a d6 90 da ac b7 e0-2b 0c b5 ba 83 b7 31 c4
+                self.badprng_get16(0x165EC8F+1)
+            )
+        self.default_key, self.bytes_iv_negone, self.bytes_iv_one = badprng_key_cache[ver]
 
     def badprng_intmath(self, v):
         # v = 00 00 80 74 56 c7 c4 41, cvttsd2si this
@@ -80,23 +113,255 @@ class BadPRNG():
             bytes_result += struct.pack("I", f.astype(np.uint32))
         return bytes_result
 
+    # *_py are the same steps in plain python ints/floats, selected with backend="python"
+    def badprng_intmath_py(self, v):
+        v2 = cvttsd2si(float(v & 0xFFFFFFFF))
+        v3 = (v2 & 0xFFFFFFFF) + ((-2092037281 * v2) >> 32)
+        v3 = wrap_int32(v3) >> 16
+        v4 = wrap_int32(16807 * v2 - 0x7FFFFFFF * (v3 + ((v3 & 0xFFFFFFFF) >> 31)))
+
+        if v4 <= 0:
+            v4 += 0x7FFFFFFF
+        return v4
+
+    def badprng_floatmath_py(self, v4):
+        return float(v4)*4.656612875e-10
+
+    def badprng_nextfloat_py(self, prng):
+        if self.ver >= noita_versions["oct10"]:
+            if prng["seed"] >= 2147483647.0:
+                prng["seed"] = prng["seed"]*0.5
+        v4 = self.badprng_intmath_py(cvttsd2si(prng["seed"]))
+        prng["seed"] = float(v4)
+        return self.badprng_floatmath_py(v4)
+
+    def badprng_init_py(self, seed):
+        return {"seed": float(seed)}
+
+    def badprng_get16_py(self, int_seed):
+        prng = self.badprng_init_py(int_seed)
+        _ = self.badprng_nextfloat_py(prng)
+
+        words = []
+        for i in range(4):
+            f = self.badprng_nextfloat_py(prng)*-2.147483648e9
+            words.append(int(f) & 0xFFFFFFFF)
+        return struct.pack("IIII", *words)
+
+    # *_many are the same steps as above over whole arrays, one PRNG per element.
+    # v is an np.int32 array, returns the np.int32 array of v4s
+    def badprng_intmath_many(self, v):
+        v2 = v.astype(np.uint32).astype(np.float64).astype(np.int32)
+        v3 = v2.astype(np.uint32).astype(np.int64) + ((np.int64(-2092037281) * v2.astype(np.int64)) >> np.int64(32))
+        v3 = v3.astype(np.int32) >> np.int32(16)
+        v4 = np.int32(16807) * v2 - np.int32(0x7FFFFFFF) * (v3 + (v3.astype(np.uint32) >> np.uint32(31)).astype(np.int32))
+
+        v4[v4 <= 0] += np.int32(0x7FFFFFFF)
+        return v4
+
+    # seeds is an np.float64 array of PRNG states, updated in place
+    def badprng_nextfloat_many(self, seeds):
+        if self.ver >= noita_versions["oct10"]:
+            halve = seeds >= np.float64(2147483647.0)
+            seeds[halve] = seeds[halve]*np.float64(0.5)
+        v4 = self.badprng_intmath_many(seeds.astype(np.int32))
+        seeds[:] = v4
+        # not self.badprng_floatmath, the python backend swaps that for a scalar one
+        return v4.astype(np.float64)*badprng_constrand
+
+    # badprng_get16 for every seed at once, returns an (N,16) np.uint8 array
+    def badprng_get16_many(self, int_seeds):
+        seeds = np.asarray(int_seeds).astype(np.float64).reshape(-1)
+        _ = self.badprng_nextfloat_many(seeds)
+
+        words = np.empty((len(seeds), 4), dtype="<u4")
+        for i in range(4):
+            f = self.badprng_nextfloat_many(seeds)*badprng_constget16
+            words[:, i] = f.astype(np.uint32)
+        return words.view(np.uint8)
+
+    # a^1..a^count mod M, for jumping ahead: after k draws from state x the state is a^k*x mod M
+    def badprng_powers(self, count):
+        powers = np.empty(count, dtype=np.uint64)
+        powers[0] = badprng_multiplier
+        filled = 1
+        while filled < count:
+            step = min(filled, count - filled)
+            powers[filled:filled+step] = (powers[:step] * powers[filled-1]) % badprng_modulus
+            filled += step
+        return powers
+
+    # draws n badprng_nextfloat results for every seed, yields (first draw index, (seeds, draws) float64 block).
+    # only the first draw needs the game's instructions, it can start from anything. after that the state is in [1, M]
+    # and it's plain Park-Miller, x*a mod M, except state M which v1 keeps forever (M*a mod M comes out 0, mapped
+    # back to M below) and oct10 halves to 1073741823 before carrying on as normal.
+    # blocks hold at most chunk_size floats, so n can be far larger than what fits in memory.
+    def badprng_stream_chunks(self, seeds, n, chunk_size=1 << 20):
+        seeds = np.asarray(seeds).astype(np.float64).reshape(-1)
+        if n <= 0 or len(seeds) == 0:
+            return
+        draws = max(1, min(n, chunk_size // len(seeds)))
+        powers = self.badprng_powers(draws)
+
+        first = self.badprng_nextfloat_many(seeds)
+        yield 0, first[:, None]
+
+        states = seeds.astype(np.uint64)
+        if self.ver >= noita_versions["oct10"]:
+            states[states == badprng_modulus] = badprng_modulus // np.uint64(2)
+        pos = 1
+        while pos < n:
+            count = min(draws, n - pos)
+            ahead = (states[:, None] * powers[None, :count]) % badprng_modulus
+            ahead[ahead == 0] = badprng_modulus
+            states = ahead[:, -1]
+            yield pos, ahead * badprng_constrand
+            pos += count
+
+    # n draws from one seed, same as calling badprng_nextfloat n times on badprng_init(seed)
+    def badprng_stream(self, seed, n, chunk_size=1 << 20):
+        result = np.empty(max(n, 0), dtype=np.float64)
+        for pos, block in self.badprng_stream_chunks([seed], n, chunk_size):
+            result[pos:pos+block.shape[1]] = block[0]
+        return result
+
+    # (seeds, n) array of draws, row i is badprng_stream(seeds[i], n)
+    def badprng_stream_many(self, seeds, n, chunk_size=1 << 20):
+        seeds = np.asarray(seeds).reshape(-1)
+        result = np.empty((len(seeds), max(n, 0)), dtype=np.float64)
+        for pos, block in self.badprng_stream_chunks(seeds, n, chunk_size):
+            result[:, pos:pos+block.shape[1]] = block
+        return result
+
+    stream = badprng_stream
+    stream_many = badprng_stream_many
+
 def testrng():
+    passed = True
+    prng = BadPRNG(noita_versions["classic"])
     for test in rngtests:
-        v4 = badprng_intmath(test[0])
+        v4 = prng.badprng_intmath(test[0])
         if v4.view("u4") != test[1]:
             print("RNG test failed intmath result, input 0x{:08x} expected 0x{:08x} - got 0x{:08x}".format(
                 test[0], test[1], v4.view("u4")
             ))
-            IPython.embed()
-        
-        floatres = badprng_floatmath(v4)
+            passed = False
+
+        v4_many = prng.badprng_intmath_many(np.array([test[0]], dtype=np.int64).astype(np.int32))
+        if v4_many.view("u4")[0] != test[1]:
+            print("RNG test failed intmath_many result, input 0x{:08x} expected 0x{:08x} - got 0x{:08x}".format(
+                test[0], test[1], v4_many.view("u4")[0]
+            ))
+            passed = False
+
+        floatres = prng.badprng_floatmath(v4)
         if floatres.view("u8") != test[2]:
             print("RNG test failed floatmath result, input 0x{:08x} expected 0x{:08x} - got 0x{:08x}".format(
                 v4.view("u4"), test[2], floatres.view("u8")
             ))
-            IPython.embed()
+            passed = False
+
+        print("RNG test {}: {}".format("passed" if passed else "failed", test))
+    return passed
+
+# batch keygen has to match the scalar one bit for bit, including the seeds that wrap past 2^31
+def testrng_many(count=4096):
+    passed = True
+    seeds = [0x165EC8F+i for i in range(count)] + [(0x165EC8F+0x7FFFFFFE) & 0xFFFFFFFF, 0, 1, 0x7FFFFFFF, 0xFFFFFFFF]
+    for ver in noita_versions.values():
+        prng = BadPRNG(ver)
+        many = prng.badprng_get16_many(seeds)
+        for seed, row in zip(seeds, many):
+            if prng.badprng_get16(seed) != row.tobytes():
+                print("RNG test failed get16_many, version {} seed 0x{:08x}".format(ver, seed))
+                passed = False
+                break
+        print("RNG get16_many test {}: version {}, {} seeds".format("passed" if passed else "failed", ver, len(seeds)))
+    return passed
+
+# the python backend has to agree with numpy for every seed, the batch path is the reference since it's fast enough
+# to cover millions of them and testrng_many already ties it to the scalar numpy path
+def testbackends(count=2000000):
+    passed = True
+    seeds = np.random.default_rng().integers(0, 0x100000000, size=count, dtype=np.uint64)
+    seeds = [0x165EC8F, (0x165EC8F+0x7FFFFFFE) & 0xFFFFFFFF, 0, 1, 0x7FFFFFFE, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF] + seeds.tolist()
+    for ver in noita_versions.values():
+        prng_np = BadPRNG(ver)
+        prng_py = BadPRNG(ver, backend="python")
+        for test in rngtests:
+            v4 = prng_py.badprng_intmath(test[0])
+            if v4 & 0xFFFFFFFF != test[1] or struct.unpack("Q", struct.pack("d", prng_py.badprng_floatmath(v4)))[0] != test[2]:
+                print("RNG test failed python backend, version {} test {}".format(ver, test))
+                passed = False
+
+        expected = prng_np.badprng_get16_many(seeds).tobytes()
+        for i, seed in enumerate(seeds):
+            if prng_py.badprng_get16(seed) != expected[i*16:i*16+16]:
+                print("RNG test failed python backend get16, version {} seed 0x{:08x}".format(ver, seed))
+                passed = False
+                break
+        for seed in seeds[:10000]:
+            if prng_py.badprng_get16(seed) != prng_np.badprng_get16(seed):
+                print("RNG test failed python backend vs numpy scalar get16, version {} seed 0x{:08x}".format(ver, seed))
+                passed = False
+                break
+        # the batch paths on a python backend instance still have to work and agree with numpy
+        if prng_py.badprng_get16_many(seeds[:10000]).tobytes() != expected[:10000*16]:
+            print("RNG test failed python backend get16_many, version {}".format(ver))
+            passed = False
+        for seed in seeds[:8]:
+            if prng_py.stream(seed, 100).tobytes() != prng_np.stream(seed, 100).tobytes():
+                print("RNG test failed python backend stream, version {} seed 0x{:08x}".format(ver, seed))
+                passed = False
+                break
+        print("RNG backend test {}: version {}, {} seeds".format("passed" if passed else "failed", ver, len(seeds)))
+    return passed
+
+# streams have to match badprng_nextfloat draw for draw, across chunk boundaries and from the seeds that start on M
+def teststream(n=3000, chunk_size=4096):
+    passed = True
+    seeds = [0x165EC8F, 0, 1, 0x7FFFFFFE, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF, 4294967296.5] + \
+        np.random.default_rng().integers(0, 0x100000000, size=8, dtype=np.uint64).tolist()
+    for ver in noita_versions.values():
+        prng = BadPRNG(ver)
+        many = prng.badprng_stream_many(seeds, n, chunk_size=chunk_size)
+        for seed, row in zip(seeds, many):
+            state = prng.badprng_init(seed)
+            expected = np.array([prng.badprng_nextfloat(state) for i in range(n)])
+            single = prng.badprng_stream(seed, n, chunk_size=chunk_size//3)
+            if not (expected.view("u8") == row.view("u8")).all() or not (expected.view("u8") == single.view("u8")).all():
+                print("RNG stream test failed, version {} seed {}".format(ver, seed))
+                passed = False
+                break
+        print("RNG stream test {}: version {}, {} seeds x {} draws".format("passed" if passed else "failed", ver, len(seeds), n))
+    return passed
+
+def benchbackends(number=20000):
+    def ns_per_call(fn, arg, n):
+        time_start = time.perf_counter()
+        for i in range(n):
+            fn(arg)
+        return (time.perf_counter() - time_start) / n * 1e9
 
-        print("RNG test passed: {}".format(test))
+    for ver in noita_versions.values():
+        for backend in badprng_backends:
+            prng = BadPRNG(ver, backend=backend)
+            print("[bench] version {} {:6s} intmath {:8.0f} ns/call, get16 {:8.0f} ns/call".format(
+                ver, backend,
+                ns_per_call(prng.badprng_intmath, 0x298eace9, number),
+                ns_per_call(prng.badprng_get16, 0x165EC8F, number)))
+        prng = BadPRNG(ver)
+        seeds = 0x165EC8F + np.arange(number)
+        time_start = time.perf_counter()
+        prng.badprng_get16_many(seeds)
+        print("[bench] version {} numpy  get16_many {:8.0f} ns/seed".format(ver, (time.perf_counter() - time_start) / number * 1e9))
+        time_start = time.perf_counter()
+        prng.badprng_stream_many(seeds[:100], number*10)
+        print("[bench] version {} numpy  stream_many {:7.1f} ns/draw".format(ver, (time.perf_counter() - time_start) / (number*1000) * 1e9))
 
 if __name__ == "__main__":
     testrng()
+    testrng_many()
+    testbackends()
+    teststream()
+    benchbackends()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# sweep BadPRNG seeds for the key/iv that turns a known plaintext into a known ciphertext.
+# keys are get16(seed), ivs are get16(seed+delta), same as the wak keys (delta 1 and 0x7FFFFFFE).
+import sys, argparse, os, time, json
+from pathlib import Path
+from multiprocessing import Pool, freeze_support
+
+import numpy as np
+from Cryptodome.Cipher import AES
+
+from badprng import *
+from aestest import h2b, find_matching_aes
+
+
+# deltas the wak code uses for its ivs, bytes_iv_one and bytes_iv_negone
+default_deltas = [1, 0x7FFFFFFE]
+chunk_size = 1 << 20
+seed_space = 1 << 32
+
+# one ECB call per key over [p, p^iv, iv] (p^iv and iv for every delta) covers the first block of every mode get_each_aes tries:
+#   ECB    E(p) == c
+#   CBC    E(p^iv) == c
+#   OFB    E(iv) == p^c, CTR-iv is the same on the first block
+#   CFB    E(iv)[0] == (p^c)[0], aestest's CFB is CFB-8 so only the first byte lines up
+# CTR without an iv has a random nonce and can't match, GCM needs its own setup per key so it's --slow only.
+# anything that gets through is checked with find_matching_aes over the whole plaintext.
+def search_chunk(task):
+    ver, start, count, deltas, plaintext, ciphertext, slow = task
+    prng = BadPRNG(ver)
+    seeds = (np.uint64(start) + np.arange(count, dtype=np.uint64)) & np.uint64(0xFFFFFFFF)
+    keys = prng.badprng_get16_many(seeds)
+    keys_bytes = keys.tobytes()
+
+    p = np.frombuffer(plaintext[:16], dtype=np.uint8)
+    c = np.frombuffer(ciphertext[:16], dtype=np.uint8)
+    pc = p ^ c
+    # every delta's blocks go behind p in one row, so each key gets one cipher and one ECB call:
+    # [p, p^iv_0, iv_0, p^iv_1, iv_1, ...]
+    ivs = [prng.badprng_get16_many((seeds + np.uint64(delta)) & np.uint64(0xFFFFFFFF)) for delta in deltas]
+    width = 16*(1 + 2*len(deltas))
+    blocks = np.empty((count, width), dtype=np.uint8)
+    blocks[:, 0:16] = p
+    for delta_i, delta_ivs in enumerate(ivs):
+        blocks[:, 16 + 32*delta_i:32 + 32*delta_i] = p ^ delta_ivs
+        blocks[:, 32 + 32*delta_i:48 + 32*delta_i] = delta_ivs
+    blocks_bytes = blocks.tobytes()
+
+    out = bytearray(count*width)
+    out_view = memoryview(out)
+    for i in range(count):
+        AES.new(keys_bytes[i*16:i*16+16], AES.MODE_ECB).encrypt(blocks_bytes[i*width:(i+1)*width], output=out_view[i*width:(i+1)*width])
+    out = np.frombuffer(out, dtype=np.uint8).reshape(count, width // 16, 16)
+
+    hits = []
+    for delta_i, delta in enumerate(deltas):
+        delta_ivs = ivs[delta_i]
+        stream = out[:, 2 + 2*delta_i]
+        candidates = (out[:, 1 + 2*delta_i] == c).all(axis=1) | (stream[:, 0] == pc[0])
+        # ECB doesn't use the iv, only look for it once
+        if delta_i == 0:
+            candidates |= (out[:, 0] == c).all(axis=1)
+
+        if slow:
+            for i in range(count):
+                if not candidates[i]:
+                    key = keys_bytes[i*16:i*16+16]
+                    if AES.new(key, AES.MODE_GCM, delta_ivs[i].tobytes()).encrypt(plaintext[:16]) == ciphertext[:16]:
+                        candidates[i] = True
+
+        for i in np.flatnonzero(candidates):
+            key = keys_bytes[i*16:i*16+16]
+            iv = delta_ivs[i].tobytes()
+            for mode, _ in find_matching_aes(plaintext, key, iv, ciphertext):
+                if mode == "ECB" and delta_i != 0:
+                    continue
+                hits.append({"ver": ver, "seed": int(seeds[i]), "delta": None if mode == "ECB" else delta, "mode": mode,
+                             "key": key.hex(), "iv": None if mode == "ECB" else iv.hex()})
+    return ver, start, count, hits
+
+# state is the search parameters, the chunks done so far per version, and the hits.
+# a state for different parameters is refused rather than mixed in.
+def load_state(state_path, params):
+    state = {"params": params, "done": {}, "hits": []}
+    if state_path is None or not state_path.is_file():
+        return state
+    with open(state_path, 'r') as f:
+        saved = json.load(f)
+    if saved["params"] != params:
+        raise ValueError("state {} is for a different search: {}".format(state_path, saved["params"]))
+    return saved
+
+def save_state(state_path, state):
+    if state_path is None:
+        return
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=0, sort_keys=True)
+    os.replace(str(tmp_path), str(state_path))
+
+def format_hit(hit):
+    delta = "-" if hit["delta"] is None else "0x{:08x}".format(hit["delta"])
+    return "version {} seed 0x{:08x} iv delta {} {}: key {} iv {}".format(
+        hit["ver"], hit["seed"], delta, hit["mode"], hit["key"], hit["iv"])
+
+# sweep [start, end) of the seed space for each version, returns the list of hits.
+# with a state_path, finished chunks are saved every save_every seconds and on every hit, and skipped on the next run.
+def keysearch(plaintext, ciphertext, versions, deltas=default_deltas, start=0, end=seed_space, jobs=1, state_path=None, slow=False, save_every=10):
+    if len(plaintext) != len(ciphertext) or len(plaintext) == 0 or len(plaintext) % 16:
+        raise ValueError("plaintext and ciphertext need to be the same length, a multiple of 16 bytes")
+
+    params = {"plaintext": plaintext.hex(), "ciphertext": ciphertext.hex(), "versions": list(versions), "deltas": list(deltas),
+              "start": start, "end": end, "chunk_size": chunk_size, "slow": slow}
+    state = load_state(state_path, params)
+    done = {ver: set(state["done"].get(str(ver), [])) for ver in versions}
+
+    tasks = []
+    for ver in versions:
+        for chunk_start in range(start, end, chunk_size):
+            if chunk_start not in done[ver]:
+                tasks.append((ver, chunk_start, min(chunk_size, end-chunk_start), list(deltas), plaintext, ciphertext, slow))
+
+    total_seeds = (end-start) * len(versions)
+    seeds_done = total_seeds - sum(task[2] for task in tasks)
+    if seeds_done:
+        print("[+] Resuming, {} of {} seeds already searched, {} hits so far".format(seeds_done, total_seeds, len(state["hits"])))
+
+    def sync():
+        state["done"] = {str(ver): sorted(done[ver]) for ver in versions}
+        save_state(state_path, state)
+
+    time_start = time.perf_counter()
+    time_saved = time_start
+    seeds_this_run = 0
+    pool = Pool(jobs)
+    try:
+        for ver, chunk_start, count, hits in pool.imap_unordered(search_chunk, tasks):
+            done[ver].add(chunk_start)
+            seeds_done += count
+            seeds_this_run += count
+            for hit in hits:
+                print("[+] Found {}".format(format_hit(hit)))
+            state["hits"].extend(hits)
+
+            now = time.perf_counter()
+            if hits or now - time_saved >= save_every:
+                sync()
+                time_saved = now
+                rate = seeds_this_run / (now - time_start)
+                eta = (total_seeds - seeds_done) / rate if rate else 0
+                print("[+] {}/{} seeds ({:.2f}%), {:.0f} seeds/s, {:.1f}h left".format(
+                    seeds_done, total_seeds, 100.0*seeds_done/total_seeds, rate, eta/3600), file=sys.stderr)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        sync()
+    return state["hits"]
+
+# the wak header is the default key and bytes_iv_one in OFB, find it around the real seed
+def testsearch(radius=2048):
+    passed = True
+    data = bytes(16)
+    for ver in noita_versions.values():
+        prng = BadPRNG(ver)
+        result = AES.new(prng.default_key, AES.MODE_OFB, prng.bytes_iv_one).encrypt(data)
+        hits = keysearch(data, result, [ver], start=0x165EC8F-radius, end=0x165EC8F+radius)
+        found = {(hit["seed"], hit["delta"], hit["mode"]) for hit in hits}
+        if (0x165EC8F, 1, "OFB") not in found or (0x165EC8F, 1, "CTR-iv") not in found:
+            print("keysearch test failed, version {} found {}".format(ver, sorted(found)))
+            passed = False
+    if passed:
+        print("keysearch test passed")
+    return passed
+
+if __name__ == "__main__":
+    freeze_support()
+    ap = argparse.ArgumentParser(description="Search BadPRNG seeds for the AES key/iv and mode that encrypt -p into -c. ex: keysearch.py -c <first 16 bytes of data.wak> -s search.json")
+    ap.add_argument('-p', dest='plaintext', help='Known plaintext in hex. Defaults to zeros as long as -c.')
+    ap.add_argument('-c', dest='ciphertext', help='Known ciphertext in hex, a multiple of 16 bytes. ex: -c "a5 58 e1 18 ..."')
+    ap.add_argument('-m', dest='noita_versions', default=list(noita_versions.values()), type=int, nargs='+', help='BadPRNG versions to search. Defaults to all of them.')
+    ap.add_argument('-d', dest='deltas', default=default_deltas, type=lambda s: int(s, 0), nargs='+', help='iv seed = key seed + delta. Defaults to the ones the wak uses, 1 and 0x7FFFFFFE.')
+    ap.add_argument('--start', default=0, type=lambda s: int(s, 0), help='First key seed to try.')
+    ap.add_argument('--end', default=seed_space, type=lambda s: int(s, 0), help='Key seed to stop before. Defaults to the full 32 bit space.')
+    ap.add_argument('-j', dest='jobs', default=os.cpu_count(), type=int, help='Number of worker processes to search with.')
+    ap.add_argument('-s', dest='state', type=Path, help='State file to save progress and hits to, rerun with the same arguments to resume.')
+    ap.add_argument('--slow', action='store_true', help='Also try GCM, several times slower.')
+    ap.add_argument('--test', action='store_true', help='Find the wak header key near its real seed and exit.')
+    args = ap.parse_args()
+
+    if args.test:
+        sys.exit(0 if testsearch() else 1)
+    if args.ciphertext is None:
+        ap.error("-c is required")
+
+    ciphertext = h2b(args.ciphertext)
+    plaintext = h2b(args.plaintext) if args.plaintext else bytes(len(ciphertext))
+    try:
+        hits = keysearch(plaintext, ciphertext, args.noita_versions, args.deltas, args.start, args.end, args.jobs, args.state, args.slow)
+    except ValueError as err:
+        print("[:(] {}".format(err))
+        sys.exit(1)
+
+    if not hits:
+        print("[:(] No seed in 0x{:08x}-0x{:08x} matched".format(args.start, args.end))
+    for hit in hits:
+        print(format_hit(hit))
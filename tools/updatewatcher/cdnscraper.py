@@ -5,17 +5,21 @@ from gevent import monkey
 from gevent.pool import Pool as GPool
 
 from gevent.fileobject import FileObject
+from gevent.event import AsyncResult
 #monkey.patch_ssl()
 
 from steam.exceptions import SteamError
-import logging, re, string, time, timeago, traceback, pickle
+import logging, re, string, time, timeago, traceback, pickle, os, json, shutil, hashlib, stat
 import IPython
 from pathlib import Path
-from collections import defaultdict, deque, namedtuple
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from multiprocessing import Process, Queue # just for quarantining discord
 
 from secrets import user, passwd
 
+import gameparsers # puts tools/ on sys.path
+from wakstore import remove_file, replace_file
+
 LOG = logging.getLogger()
 
 # class these out so we can treat them like enums and take diff actions on certain changes
@@ -51,12 +55,109 @@ def thread_init():
     from gevent import monkey
     monkey.patch_all()
 
-def async_download_file(out_dir, f):
+class ChunkStore():
+    """ depot chunks on disk by sha1, shared by every branch. the same chunks show up in public, noitabeta and
+        noitabeta_mods, often under different buildids, so each one should only come off the CDN once.
+        least recently used chunks go once the store is over max_size bytes. a chunk several downloads want at the
+        same time is fetched by the first one, the others wait on it """
+    def __init__(self, store_dir, max_size):
+        self.store_dir = Path(store_dir)
+        self.max_size = max_size
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        # sha -> size, oldest use first. mtime is bumped on use so the order survives restarts
+        self.chunks = OrderedDict()
+        self.size = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        found = []
+        for chunk_path in self.store_dir.glob("*/*"):
+            if chunk_path.suffix == ".part":
+                chunk_path.unlink()
+                continue
+            st = chunk_path.stat()
+            found.append((st.st_mtime, chunk_path.name, st.st_size))
+        for mtime, sha, size in sorted(found):
+            self.chunks[sha] = size
+            self.size += size
+        self.evict()
+    def chunk_path(self, sha):
+        return self.store_dir / sha[:2] / sha
+    def evict(self):
+        while self.size > self.max_size and len(self.chunks) > 0:
+            sha, size = self.chunks.popitem(last=False)
+            self.size -= size
+            try:
+                self.chunk_path(sha).unlink()
+            except OSError:
+                pass
+    def put(self, sha, data):
+        chunk_path = self.chunk_path(sha)
+        chunk_path.parent.mkdir(exist_ok=True)
+        part_path = chunk_path.with_name(sha + ".part")
+        with open(part_path, 'wb') as fout:
+            fout.write(data)
+        os.replace(str(part_path), str(chunk_path))
+        if sha not in self.chunks:
+            self.chunks[sha] = len(data)
+            self.size += len(data)
+        self.evict()
+    def get(self, sha, fetch):
+        """ decompressed chunk sha, from disk if it's here, else from fetch() """
+        if sha in self.chunks:
+            try:
+                with open(self.chunk_path(sha), 'rb') as fin:
+                    data = fin.read()
+                os.utime(str(self.chunk_path(sha)))
+                self.chunks.move_to_end(sha)
+                self.hits += 1
+                return data
+            except OSError:
+                self.size -= self.chunks.pop(sha)
+        if sha in self.in_flight:
+            self.shared += 1
+            return self.in_flight[sha].get()
+        self.misses += 1
+        result = self.in_flight[sha] = AsyncResult()
+        try:
+            data = fetch()
+            # chunk ids are the sha1 of the decompressed chunk, don't keep anything that doesn't match
+            if hashlib.sha1(data).hexdigest() == sha:
+                self.put(sha, data)
+            else:
+                LOG.error("chunk {} doesn't match its sha1, not storing it".format(sha))
+            result.set(data)
+            return data
+        except BaseException as err:
+            result.set_exception(err)
+            raise
+        finally:
+            del self.in_flight[sha]
+    def stats(self):
+        return "{} chunks, {:.1f} MB, {} hits, {} misses, {} shared with a download in flight".format(
+            len(self.chunks), self.size / 1e6, self.hits, self.misses, self.shared)
+
+# whole content of a depot file, through chunk_store if there is one
+def read_depot_file(f, chunk_store=None):
+    if chunk_store is None:
+        return f.read()
+    manifest = f.manifest
+    data = bytearray(f.size)
+    for chunk in f.chunks:
+        sha = chunk.sha.hex()
+        chunk_data = chunk_store.get(sha, lambda: manifest.cdn_client.get_chunk(manifest.app_id, manifest.depot_id, sha))
+        data[chunk.offset:chunk.offset + len(chunk_data)] = chunk_data
+    return bytes(data)
+
+# True if the file's whole content ended up on disk, False for skipped/placeholder files
+def async_download_file(out_dir, f, chunk_store=None):
     size_skip = 100000000 # > 100mb for noita is sound and shit
     names_skip = ["neverskip"]#[".png", "translations", "fonts", "audio"]
     #LOG.info("Handling {}".format(f))
     #for f in all_files:
     f_path = out_dir / Path(f.filename)
+    written = True
     if f.is_directory:
         f_path.mkdir(parents=True, exist_ok=True)
     else:
@@ -66,14 +167,98 @@ def async_download_file(out_dir, f):
         #print(f_path)
         # flush it down unless we're skipping this type
         if not any([(n in f.filename) for n in names_skip]):
-            with open(f_path, 'wb') as fout:
-                fout = FileObject(fout)
+            # written next to it and renamed over, f_path may be a hardlink into another build
+            part_path = f_path.with_name(f_path.name + ".part")
+            remove_file(part_path)
+            # the FileObject owns the file, closing it flushes its buffer before the file goes
+            fout = FileObject(open(part_path, 'wb'), 'wb')
+            try:
                 if size_skip > f.size:
-                    fout.write(f.read())
+                    fout.write(read_depot_file(f, chunk_store))
                 else:
                     fout.write(b"")
+                    written = False
+            finally:
+                fout.close()
+            # archived files get hardlinked into later builds, don't let anyone edit one in place
+            os.chmod(str(part_path), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            replace_file(part_path, f_path)
+        else:
+            written = False
     gevent.sleep()
-    return True
+    return written
+
+# (size, sha1 hex of the content) the manifest has for a file
+def depot_file_key(f):
+    return (f.size, f.file_mapping.sha_content.hex())
+
+# hardlink src to dst, copy if the filesystem can't. replaces dst without ever writing into it
+def link_or_copy(src, dst):
+    # already the same file, renaming the .part over it would do nothing and leave the .part behind
+    if dst.exists() and os.path.samefile(str(src), str(dst)):
+        return
+    part_path = dst.with_name(dst.name + ".part")
+    remove_file(part_path)
+    try:
+        os.link(str(src), str(part_path))
+    except OSError:
+        shutil.copyfile(str(src), str(part_path))
+        os.chmod(str(part_path), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    replace_file(part_path, dst)
+
+class ArchivedFiles():
+    """ every file of every archived build by (size, sha1), read from the depot_files.json each build gets once its
+        downloads finish. builds added later win, so a branch's last build is what new builds link from.
+        the json also has each file's mtime and inode from when it was written. the game runs out of these folders,
+        so a file that doesn't match them anymore got touched and isn't linked from """
+    index_name = "depot_files.json"
+    def __init__(self, archive_dir):
+        self.archive_dir = Path(archive_dir)
+        self.files = {}
+        index_paths = [p for p in self.archive_dir.glob("*/" + self.index_name)]
+        for index_path in sorted(index_paths, key=lambda p: p.stat().st_mtime):
+            try:
+                with open(index_path, 'r') as fin:
+                    self.add_build(index_path.parent, json.load(fin)["files"])
+            except (OSError, ValueError, KeyError) as err:
+                LOG.error("skipping broken {}: {}".format(index_path, err))
+    def add_build(self, build_dir, files):
+        """ files is {filename: [size, sha1 hex, mtime_ns, inode]}, anything without the stats isn't linkable """
+        for filename, entry in files.items():
+            if len(entry) == 4:
+                self.files[(entry[0], entry[1])] = (Path(build_dir) / filename, entry[2:])
+    def write_build(self, build_dir, gid, files):
+        """ files is {filename: [size, sha1 hex]}, stats get added here """
+        files = dict(files)
+        for filename, (size, sha) in list(files.items()):
+            try:
+                st = os.stat(str(Path(build_dir) / filename))
+            except OSError:
+                del files[filename]
+                continue
+            files[filename] = [size, sha, st.st_mtime_ns, st.st_ino]
+        index_path = Path(build_dir) / self.index_name
+        part_path = index_path.with_name(index_path.name + ".part")
+        with open(part_path, 'w') as fout:
+            json.dump({"gid": str(gid), "files": files}, fout)
+        os.replace(str(part_path), str(index_path))
+        self.add_build(build_dir, files)
+    def find(self, size, sha):
+        """ path of an archived file with this content, None if there isn't one (anymore) or it was changed """
+        if (size, sha) not in self.files:
+            return None
+        path, recorded = self.files[(size, sha)]
+        try:
+            st = path.stat()
+            if st.st_size != size:
+                return None
+            if [st.st_mtime_ns, st.st_ino] == recorded:
+                return path
+        except OSError:
+            pass
+        LOG.warning("{} doesn't match what was archived anymore, not linking from it".format(path))
+        del self.files[(size, sha)]
+        return None
 
 def do_nothing(): return None
 
@@ -101,22 +286,60 @@ class CDNScraper():
         # noita only has <CDNDepotManifest('Noita Content', app_id=881100, depot_id=881101, gid=8897187370775608456, creation_time='2019-10-11 15:27:55')>
         manifest_pulled = self.cdnapi.get_manifest(manifest['app_id'], manifest['depot_id'], manifest['gid'])
         all_files = list(manifest_pulled.iter_files())
-        LOG.info("[+] Downloading {} - {} files to {}".format(branch_name, len(all_files), out_dir))
+
+        # files some earlier build (any branch) already has get linked from it instead of downloaded
+        if self.archived_files is None:
+            self.archived_files = ArchivedFiles(self.download_directory)
+        if self.chunk_store is None:
+            self.chunk_store = ChunkStore(self.download_directory / "chunks", self.options.get("chunk_store_size", self.default_chunk_store_size))
+        linked = {}
+        for f in all_files:
+            if f.is_file and not f.is_symlink:
+                size, sha = depot_file_key(f)
+                src = self.archived_files.find(size, sha)
+                if src is None:
+                    continue
+                f_path = out_dir / Path(f.filename)
+                try:
+                    f_path.parent.mkdir(parents=True, exist_ok=True)
+                    link_or_copy(src, f_path)
+                    linked[f.filename] = [size, sha]
+                except OSError as err:
+                    LOG.error("couldn't link {} from {}, downloading it: {}".format(f_path, src, err))
+        to_download = [f for f in all_files if f.filename not in linked]
+        LOG.info("[+] Downloading {} - {} of {} files to {}, {} linked from earlier builds".format(
+            branch_name, len(to_download), len(all_files), out_dir, len(linked)))
 
         # per-file threading breaks gevent.ThreadPool
         if True:
-            for f in all_files:
+            for f in to_download:
                 if True: # dl_async
                     #promises.append(self.download_pool.apply_async(async_download_file, (out_dir, f)))
-                    promises.append(self.download_pool.spawn(async_download_file, *(out_dir, f)))
+                    promises.append(self.download_pool.spawn(async_download_file, *(out_dir, f, self.chunk_store)))
                 else:
                     promises.append(gevent.spawn(do_nothing))
-                    async_download_file(out_dir, f)
+                    async_download_file(out_dir, f, self.chunk_store)
         #promises.append(self.download_pool.submit(async_download_file, *(out_dir, all_files)))
         #IPython.embed()
-        
+
+        # the build's file list goes down once everything's on disk, so later builds can link from this one
+        downloads = list(zip(to_download, promises))
+        promises.append(gevent.spawn(self.finish_build, out_dir, manifest_pulled.gid, linked, downloads))
         return promises
 
+    def finish_build(self, out_dir, gid, linked, downloads):
+        """ record what out_dir has in full: linked files and downloads that finished and weren't skipped """
+        gevent.joinall([g for f, g in downloads])
+        files = dict(linked)
+        for f, g in downloads:
+            if f.is_file and not f.is_symlink and g.successful() and g.value:
+                files[f.filename] = list(depot_file_key(f))
+        failed = sum(1 for f, g in downloads if not g.successful())
+        if failed > 0:
+            LOG.error("{} downloads into {} failed".format(failed, out_dir))
+        self.archived_files.write_build(out_dir, gid, files)
+        LOG.info("chunk store: {}".format(self.chunk_store.stats()))
+
     def get_manifests(self, appid, branch=None, retries=5):
         """ Handle CDN errors :( """
         while retries > 0:
@@ -259,6 +482,8 @@ class CDNScraper():
         state = self.__dict__.copy()
         del state["download_pool"] # gevent.threadpool.ThreadPool unserializable, no shit
         del state["cdnapi"]        # don't trust third party libraries to handle pickling
+        state["archived_files"] = None # rebuilt from the archive on the next update
+        state["chunk_store"] = None    # same, holds greenlet state while downloads run
         #LOG.info("serializing scraper:\n{}".format(state))
 
         return state
@@ -280,6 +505,8 @@ class CDNScraper():
         self.options = options
         self.appid = options["appid"]
         self.download_directory = Path(options["download_directory"]).absolute()
+        self.archived_files = None
+        self.chunk_store = None
 
         self.download_pool = GPool(16)#ThreadPoolExecutor(16, initializer=thread_init)
 
@@ -290,8 +517,10 @@ class CDNScraper():
                     "noitabeta": default_update_handler,
                     "noitabeta_mods": default_update_handler
                 },
-                "download_directory": r"./archive/"
+                "download_directory": r"./archive/",
+                "chunk_store_size": 4*1024*1024*1024 # bytes of depot chunks kept in archive/chunks
             }
+    default_chunk_store_size = default_options["chunk_store_size"]
 
     # need these two for pickling support
     def default_branchinfo(self):
@@ -310,6 +539,8 @@ class CDNScraper():
         # everything below here is just default empty state
         self.branch_actions= {}
         self.download_pool = GPool(16)#ThreadPoolExecutor(16, initializer=thread_init)
+        self.archived_files = None # ArchivedFiles, loaded on the first update
+        self.chunk_store = None    # ChunkStore, same
 
         self.last_check = 0
         self.check_interval = 5 # seconds
@@ -0,0 +1,58 @@
+import gevent
+
+import logging, traceback, time
+from pathlib import Path
+
+from gameparsers.gameparser import GameParser
+from wakindex import WAKIndex
+from waktrans import TranslationStore
+from wakparsing import open_wak, WAKError
+LOG = logging.getLogger()
+
+class GameParserNoitaIndex(GameParser):
+    """ adds the build's data.wak to the full-text index shared by every build, archive/wakindex.sqlite,
+        and its translations to archive/translations """
+    def __init__(self, game_path, storage_path):
+        LOG.info("wak index started")
+        self.finished = False
+        self.game_path = Path(game_path)
+        self.storage_path = Path(storage_path)
+        self.index_path = self.storage_path.parent / "wakindex.sqlite"
+        self.translations_path = self.storage_path.parent / "translations"
+        self.threads = []
+        self.errors = []
+        self.result = []
+        # gevent will pass self automagically.
+        self.threads.append(gevent.spawn(self.index_worker))
+    def get_changes(self):
+        if not self.finished:
+            LOG.error("getting changes before parsing finished")
+            return None
+        return self.result
+    def get_result(self):
+        if not self.finished:
+            LOG.error("getting changes before parsing finished")
+            return None
+        return self.result
+    def index_worker(self):
+        # 881100_<buildid>_<branch>, same name the archive folder has
+        build_name = self.game_path.name
+        datawak_path = self.game_path / "data/data.wak"
+        try:
+            if not datawak_path.exists():
+                raise WAKError("no data.wak at {}".format(datawak_path))
+            time_start = time.time()
+            with WAKIndex(self.index_path) as index, open_wak(datawak_path) as wak:
+                indexed = index.add_build(build_name, wak)
+                translations = TranslationStore(self.translations_path)
+                counts = translations.add_build(build_name, wak)
+            if indexed is not None:
+                LOG.info("indexed {}: {} files, {} new, {:.2f}s".format(build_name, *indexed, time.time() - time_start))
+            if counts is not None:
+                LOG.info("translations of {} against {}: {} added, {} changed, {} removed".format(
+                    build_name, translations.base(build_name), *counts))
+        except Exception as err:
+            errmsg = "failed to index {}: {}".format(build_name, ''.join(traceback.format_exception(etype=type(err), value=err, tb=err.__traceback__)))
+            LOG.error(errmsg)
+            self.errors.append(errmsg)
+        self.finished = True
@@ -7,6 +7,10 @@ from collections import defaultdict, deque, namedtuple
 
 from gameparsers.gameparser import GameParser
 from gameparsers.noitapatcher import patch_noita
+from wakstore import BlobStore
+from wakman import extract_files
+from wakparsing import open_wak, WAKError
+from wakdeps import LuaDepGraph
 LOG = logging.getLogger()
 
 class GameParserNoitaRuntimeAnalysis(GameParser):
@@ -15,6 +19,8 @@ class GameParserNoitaRuntimeAnalysis(GameParser):
         self.finished = False
         self.game_path = Path(game_path)
         self.storage_path = Path(storage_path)
+        # shared by every build, archive/blobstore next to archive/881100_<buildid>_<branch>_GameParserNoitaRuntimeAnalysis
+        self.blob_store = BlobStore(self.storage_path.parent / "blobstore")
         self.threads = []
         self.errors = []
         # gevent will pass self automagically.
@@ -61,13 +67,16 @@ class GameParserNoitaRuntimeAnalysis(GameParser):
                     os.makedirs(dest_path)
                 shutil.copyfile(os.path.join(root, file), os.path.join(dest_path, file))
     def copytree_to_storage(self, s):
+        """ files go into the shared blob store, we only keep a manifest named after our storage folder.
+        blob_store.materialize(manifest name, somewhere) hardlinks the tree back out when it's needed. """
         if type(s) is str:
             s = Path(s)
         if not s.is_dir():
             raise ValueError("can't copytree if not a dir: {}".format(s))
-        new_path = Path(self.storage_path) / s.name
-        self.copytree(str(s), str(new_path))
-        return new_path
+        manifest = self.blob_store.put_tree(s)
+        # keep the tree's top folder in the paths, same as the old copy into storage_path / s.name
+        manifest = {"{}/{}".format(s.name, path): digest for path, digest in manifest.items()}
+        return self.blob_store.save_manifest(Path(self.storage_path).name, manifest)
     def copy_to_storage(self, s):
         if type(s) is str:
             s = Path(s)
@@ -129,7 +138,33 @@ class GameParserNoitaRuntimeAnalysis(GameParser):
         return
 
     def try_datawak(self, game_bin):
-        """ appdata _must_ be cleaned, we use their extractor for now """
+        """ decrypt data.wak ourselves if we can, the tree is built from hashes taken while decrypting """
+        datawak_path = Path(self.game_path) / "data/data.wak"
+        if datawak_path.exists():
+            try:
+                tree_path = self.storage_path / "datawak_tree.txt"
+                with open_wak(datawak_path) as wak:
+                    extract_files(wak, self.storage_path, True,
+                        store=self.blob_store, build_name=self.storage_path.name, tree_path=tree_path, verbose=False)
+                    LOG.info("data.wak: {} files extracted to {}, tree at {}".format(len(wak.file_list), self.storage_path, tree_path))
+                    self.save_lua_deps(wak)
+                self.result.append(str(tree_path.absolute()))
+                return
+            except WAKError as err:
+                LOG.error("failed to decrypt {} ourselves, falling back to -wizard_unpak: {}".format(datawak_path, err))
+        self.try_datawak_unpak(game_bin)
+
+    def save_lua_deps(self, wak):
+        """ who-loads-what graph next to datawak_tree.txt, so a tree diff can be turned into affected files with wakdeps.py """
+        try:
+            graph = LuaDepGraph.from_wak(wak)
+            graph.save(self.storage_path / "luadeps.npz")
+            LOG.info("lua deps: {} files, {} edges".format(len(graph.paths), len(graph)))
+        except Exception as err:
+            LOG.error("failed to build lua deps: {}".format(err))
+
+    def try_datawak_unpak(self, game_bin):
+        """ appdata _must_ be cleaned, we use their extractor """
         self.launch_game_and_wait([str(game_bin.resolve()), "-wizard_unpak"])
 
         # Did it unpak successfully?
@@ -0,0 +1,7 @@
+# wakman and friends live one folder up in tools/, let the parsers import them
+import sys
+from pathlib import Path
+
+tools_dir = str(Path(__file__).resolve().parents[2])
+if tools_dir not in sys.path:
+    sys.path.append(tools_dir)
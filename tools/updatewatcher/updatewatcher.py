@@ -29,6 +29,7 @@ from disco_bot import BotCommand
 from gameparsers.GameParserNoitaRuntimeAnalysis import GameParserNoitaRuntimeAnalysis
 from gameparsers.GameParserNoitaStaticAnalysis import GameParserNoitaStaticAnalysis
 from gameparsers.GameParserNoitaStrings import GameParserNoitaStrings
+from gameparsers.GameParserNoitaIndex import GameParserNoitaIndex
 
 # get-content .\running.log -Wait -Tail 10
 logging.basicConfig(filename="running.log", format="%(asctime)s:%(levelname)s:%(name)s| %(message)s", level=logging.INFO)
@@ -77,7 +78,7 @@ class Hämis:
             self.scraper = CDNScraper(self.cdnapi)
             LOG.info("Started new scraper:\n{}".format(self.scraper.__dict__))
 
-        self.game_parsers = [GameParserNoitaRuntimeAnalysis, GameParserNoitaStrings, GameParserNoitaStaticAnalysis] # GameParserNoitaWAK, GameParserNoitaComponents,
+        self.game_parsers = [GameParserNoitaRuntimeAnalysis, GameParserNoitaStrings, GameParserNoitaStaticAnalysis, GameParserNoitaIndex] # GameParserNoitaWAK, GameParserNoitaComponents,
 
         # run PER-BRANCH after parsers complete.
         from publishers.gitpublisher import GitPublisher
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# times the wak code and the updatewatcher parsers on synthetic waks, so regressions show up before a real build does.
+#   python3 wakbench.py -o bench.json                 # run and save
+#   python3 wakbench.py -b bench.json -t 0.15         # run, compare against bench.json, exit 1 if anything got >15% slower
+import sys, argparse, os, time, json, platform, tempfile, shutil, statistics
+from pathlib import Path
+
+import numpy as np
+
+from badprng import *
+from wakparsing import *
+from wakcrypto import get_backend
+from wakman import extract_files
+
+# the parsers live in updatewatcher and pull in gevent, benchmarks that need them are skipped without it
+sys.path.append(str(Path(__file__).resolve().parent / "updatewatcher"))
+try:
+    from gameparsers.GameParserNoitaStrings import GameParserNoitaStrings
+    from gameparsers.GameParserNoitaRuntimeAnalysis import GameParserNoitaRuntimeAnalysis
+    from gameparsers.noitapatcher import find_pattern_in_buffer
+    gameparsers_error = None
+except ImportError as err:
+    gameparsers_error = err
+
+# roughly what a data.wak looks like: lots of small xml/lua, fewer but bigger images and audio
+fixture_kinds = [
+    # (folder, extension, share of entries, lognormal mu, lognormal sigma)
+    ("entities", "xml", 0.45, 7.0, 0.9),
+    ("scripts",  "lua", 0.20, 7.5, 1.0),
+    ("ui_gfx",   "png", 0.25, 8.5, 1.4),
+    ("audio",    "bank", 0.02, 13.0, 1.0),
+    ("translations", "csv", 0.08, 9.0, 1.5),
+]
+fixture_max_size = 16*1024*1024
+text_words = [b"<Entity>", b"</Entity>", b"<Base file=\"data/entities/base.xml\">", b"dofile_once(\"data/scripts/lib.lua\")",
+              b"EntityLoad", b"local", b"function", b"end", b"\n", b"  ", b"name=\"", b"\"", b"1.0", b"true"]
+
+# deterministic for (count, seed), text-ish for xml/lua/csv so the string scan has something to find
+def fixture_entries(count, seed=0):
+    rng = np.random.default_rng(seed)
+    shares = np.array([k[2] for k in fixture_kinds])
+    kinds = rng.choice(len(fixture_kinds), size=count, p=shares/shares.sum())
+    for i, k in enumerate(kinds):
+        folder, ext, share, mu, sigma = fixture_kinds[k]
+        size = int(min(max(rng.lognormal(mu, sigma), 1), fixture_max_size))
+        if ext in ("xml", "lua", "csv"):
+            words = rng.choice(len(text_words), size=size//6 + 1)
+            data = b" ".join(text_words[w] for w in words)[:size]
+        else:
+            data = rng.integers(0, 256, size=size, dtype=np.uint8).tobytes()
+        yield ("data/{}/d{}/f{}.{}".format(folder, i % 41, i, ext), data)
+
+# fixtures are kept in fixture_dir between runs, named after what went into them
+def make_fixture(fixture_dir, ver, count, seed=0):
+    path = Path(fixture_dir) / "bench_v{}_n{}_s{}.wak".format(ver, count, seed)
+    if not path.is_file():
+        print("[+] Writing fixture {}".format(path))
+        tmp_path = path.with_suffix(".tmp")
+        WAKWriter(ver).write(tmp_path, fixture_entries(count, seed))
+        os.replace(str(tmp_path), str(path))
+    return path
+
+# fn is called repeat times, setup (if any) before each call and untimed. returns {"best", "median", "repeat"} in seconds
+def time_it(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        time_start = time.perf_counter()
+        if setup is not None:
+            fn(arg)
+        else:
+            fn()
+        times.append(time.perf_counter() - time_start)
+    return {"best": min(times), "median": statistics.median(times), "repeat": repeat}
+
+def benchmark_wanted(name, only):
+    return len(only) == 0 or any(o in name for o in only)
+
+# name -> result, for every benchmark whose name contains one of only (all if empty)
+def run_benchmarks(wak_path, ver, repeat=5, jobs=1, only=()):
+    results = {}
+    def wanted(name):
+        return benchmark_wanted(name, only)
+    def bench(name, fn, setup=None, n=repeat, size=None):
+        if not wanted(name):
+            return
+        results[name] = time_it(fn, n, setup)
+        if size is not None:
+            results[name]["mb_per_s"] = size / 1e6 / max(results[name]["best"], 1e-9)
+        print("[bench] {:24s} best {:9.3f} ms  median {:9.3f} ms".format(name, results[name]["best"]*1e3, results[name]["median"]*1e3))
+
+    wak = WAKParser(wak_path, ver)
+    total_size = sum(f.size for f in wak.file_list)
+    table = wak.crypto.ctr(wak.prng.default_key, wak.prng.bytes_iv_negone, wak.datawak_contents[16:wak.datawak_head_length])
+    median_entry = sorted(wak.file_list, key=lambda f: f.size)[len(wak.file_list)//2]
+
+    bench("open", lambda: WAKParser(wak_path, ver).close())
+    bench("file_list", lambda: WAKFileList(table))
+    bench("entry_ivs", wak.entry_ivs)
+    bench("read_median_entry", lambda: wak.read_bytes(median_entry.path), n=repeat*20)
+    bench("decrypt_all", lambda: sum(len(d) for f, d in wak.decrypt_entries(wak.file_list)), size=total_size)
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix="wakbench"))
+    try:
+        out_dir = tmp_dir / "extracted"
+        def fresh_dir():
+            shutil.rmtree(str(out_dir), ignore_errors=True)
+            return out_dir
+        def extract(out, jobs=1):
+            extract_files(wak, out, jobs=jobs, incremental=False, verbose=False)
+        bench("extract_all", extract, setup=fresh_dir, size=total_size)
+        if jobs > 1:
+            bench("extract_all_j{}".format(jobs), lambda out: extract(out, jobs), setup=fresh_dir, size=total_size)
+
+        if gameparsers_error is not None:
+            print("[?] Skipping gameparser benchmarks, couldn't import them: {}".format(gameparsers_error))
+        elif wanted("strings") or wanted("find_pattern") or wanted("get_tree"):
+            if not out_dir.is_dir():
+                extract(fresh_dir())
+            # a stand-in for noita.exe, binary entries with text entries in between for strings() to match
+            buffer = bytearray()
+            for f, fdata_dec in wak.decrypt_entries(wak.file_list):
+                if len(buffer) >= 32*1024*1024:
+                    break
+                buffer += fdata_dec
+            buffer = bytes(buffer)
+            strings_parser = GameParserNoitaStrings.__new__(GameParserNoitaStrings)
+            runtime_parser = GameParserNoitaRuntimeAnalysis.__new__(GameParserNoitaRuntimeAnalysis)
+            bench("strings", lambda: sum(1 for s in strings_parser.strings(buffer)), size=len(buffer))
+            bench("find_pattern", lambda: find_pattern_in_buffer("80 3D ? ? ? ? ? 75 18", buffer), size=len(buffer))
+            bench("get_tree", lambda: runtime_parser.get_tree(str(out_dir / "data")), size=total_size)
+    finally:
+        shutil.rmtree(str(tmp_dir), ignore_errors=True)
+        wak.close()
+    return results
+
+# (name, baseline best, current best, ratio, regressed) for every benchmark in both
+def compare_results(baseline, results, threshold):
+    rows = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["best"] / max(baseline[name]["best"], 1e-12)
+        rows.append((name, baseline[name]["best"], result["best"], ratio, ratio > 1.0 + threshold))
+    return rows
+
+# baseline benchmarks that -k didn't filter out but didn't run either, ex: the gameparser ones without gevent
+def missing_results(baseline, results, only=()):
+    return sorted(name for name in baseline if name not in results and benchmark_wanted(name, only))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark wak parsing/extraction and the updatewatcher parsers on synthetic waks.")
+    ap.add_argument('-o', dest='out_json', type=Path, help='Save results to this json. ex: -o bench.json')
+    ap.add_argument('-b', dest='baseline', type=Path, help='Compare against results saved with -o earlier.')
+    ap.add_argument('-t', dest='threshold', default=0.10, type=float, help='Slowdown against -b that counts as a regression, 0.10 = 10%%.')
+    ap.add_argument('-n', dest='count', default=5000, type=int, help='Entries in the synthetic wak.')
+    ap.add_argument('-r', dest='repeat', default=5, type=int, help='Runs per benchmark, the best one is compared.')
+    ap.add_argument('-m', dest='noita_version', default=max(noita_versions.values()), type=int, help='Version of noita to build the synthetic wak for.')
+    ap.add_argument('-j', dest='jobs', default=1, type=int, help='Also time extraction with this many workers.')
+    ap.add_argument('-k', dest='only', action='append', default=[], help='Only run benchmarks with this in their name, can be repeated.')
+    ap.add_argument('--fixtures', type=Path, default=Path(tempfile.gettempdir()) / "wakbench", help='Where synthetic waks are kept between runs.')
+    args = ap.parse_args()
+
+    args.fixtures.mkdir(parents=True, exist_ok=True)
+    wak_path = make_fixture(args.fixtures, args.noita_version, args.count)
+    results = run_benchmarks(wak_path, args.noita_version, args.repeat, args.jobs, args.only)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "crypto_backend": get_backend().name,
+            "noita_version": args.noita_version,
+            "count": args.count,
+            "wak_size": wak_path.stat().st_size,
+        },
+        "results": results,
+    }
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print("[+] Saved results to {}".format(args.out_json))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("count") != args.count or baseline["meta"].get("noita_version") != args.noita_version:
+            print("[?] Baseline was run with different fixtures: {}".format(baseline["meta"]))
+        regressions = 0
+        for name, old, new, ratio, regressed in compare_results(baseline["results"], results, args.threshold):
+            print("{} {:24s} {:9.3f} ms -> {:9.3f} ms ({:+.1f}%)".format(
+                "[:(]" if regressed else "[+] ", name, old*1e3, new*1e3, (ratio - 1.0)*100))
+            regressions += regressed
+        missing = missing_results(baseline["results"], results, args.only)
+        for name in missing:
+            print("[:(] {:24s} is in the baseline but didn't run".format(name))
+        if regressions:
+            print("[:(] {} benchmarks regressed more than {:.0f}%".format(regressions, args.threshold*100))
+        if missing:
+            print("[:(] {} baseline benchmarks didn't run".format(len(missing)))
+        if regressions or missing:
+            sys.exit(1)
+        print("[+] No regressions over {:.0f}%".format(args.threshold*100))
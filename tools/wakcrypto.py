@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# the AES the wak code needs, CTR for the table and entries and OFB for the header, behind one interface so it
+# can come from whichever library is fastest here. pycryptodome is always there, cryptography (OpenSSL) gets
+# used if it's installed and wins the benchmark.
+#
+#   crypto = get_backend()               # WAKCRYPTO_BACKEND=pycryptodome (or cryptography) skips the benchmark
+#   crypto.ctr(key, iv, ciphertext)      # one entry
+#   crypto.ctr_many(key, ivs, datas)     # lots of small entries, one ECB call for all of their keystreams
+import os, sys, time
+
+import numpy as np
+from Cryptodome.Cipher import AES
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+backend_env = "WAKCRYPTO_BACKEND"
+# ctr_iter decrypts this many bytes of entries per ctr_many call
+ctr_batch_size = 4*1024*1024
+# entries this big or bigger don't gain anything from sharing an ECB call, they get their own cipher
+ctr_batch_max_entry = 64*1024
+
+class AESBackend():
+    name = None
+
+    def ecb_encrypt(self, key, data):
+        raise NotImplementedError
+
+    # stateful CTR starting at counter block iv (16 bytes, big endian), .encrypt()/.decrypt() keep going where they stopped
+    def ctr_cipher(self, key, iv):
+        raise NotImplementedError
+
+    # CTR is its own inverse, this encrypts too
+    def ctr(self, key, iv, data):
+        return self.ctr_cipher(key, iv).decrypt(data)
+
+    # only ever used on the 16 byte header, so block by block is fine
+    def ofb(self, key, iv, data):
+        out = bytearray()
+        block = bytes(iv)
+        for i in range(0, len(data), 16):
+            block = self.ecb_encrypt(key, block)
+            chunk = bytes(data[i:i+16])
+            out += bytes(a ^ b for a, b in zip(block, chunk))
+        return bytes(out)
+
+    # CTR for many entries under one key. ivs is an (N,16) uint8 array or a list of 16 byte IVs, returns a list of bytes.
+    # setting up a cipher costs more than decrypting a small entry, so the counter blocks for every small entry are
+    # built in numpy and encrypted in a single ECB call, then XORed with the ciphertext.
+    def ctr_many(self, key, ivs, datas):
+        ivs = np.asarray([np.frombuffer(bytes(iv), dtype=np.uint8) for iv in ivs] if isinstance(ivs, list) else ivs, dtype=np.uint8)
+        sizes = np.array([len(d) for d in datas], dtype=np.int64)
+        result = [None]*len(datas)
+        small = np.flatnonzero(sizes < ctr_batch_max_entry)
+        for i in np.flatnonzero(sizes >= ctr_batch_max_entry):
+            result[i] = self.ctr(key, ivs[i].tobytes(), datas[i])
+        if len(small) == 0:
+            return result
+
+        nblocks = (sizes[small] + 15) // 16
+        starts = np.zeros(len(small), dtype=np.int64)
+        np.cumsum(nblocks[:-1], out=starts[1:])
+        total = int(nblocks.sum())
+
+        # counter block j of entry i is iv_i + j mod 2^128, as two big endian 64 bit halves with the carry by hand
+        iv_words = np.ascontiguousarray(ivs[small]).view(">u8").astype(np.uint64)
+        owner = np.repeat(np.arange(len(small)), nblocks)
+        block_index = (np.arange(total, dtype=np.int64) - starts[owner]).astype(np.uint64)
+        lo = iv_words[owner, 1] + block_index
+        counters = np.empty((total, 2), dtype=">u8")
+        counters[:, 0] = iv_words[owner, 0] + (lo < iv_words[owner, 1])
+        counters[:, 1] = lo
+
+        stream = np.frombuffer(self.ecb_encrypt(key, counters.tobytes()), dtype=np.uint8).copy()
+        for n, i in enumerate(small):
+            start = int(starts[n])*16
+            size = int(sizes[i])
+            out = stream[start:start+size]
+            out ^= np.frombuffer(datas[i], dtype=np.uint8)
+            result[i] = out.tobytes()
+        return result
+
+    # items is an iterable of (iv, ciphertext), yields plaintexts in the same order.
+    # items are pulled ctr_batch_size bytes at a time, so a lazy iterable of reads stays bounded.
+    def ctr_iter(self, key, items, batch_size=ctr_batch_size):
+        ivs, datas, size = [], [], 0
+        for iv, data in items:
+            ivs.append(iv)
+            datas.append(data)
+            size += len(data)
+            if size >= batch_size:
+                yield from self.ctr_many(key, ivs, datas)
+                ivs, datas, size = [], [], 0
+        if len(datas) > 0:
+            yield from self.ctr_many(key, ivs, datas)
+
+class PycryptodomeBackend(AESBackend):
+    name = "pycryptodome"
+
+    def ecb_encrypt(self, key, data):
+        return AES.new(key, AES.MODE_ECB).encrypt(data)
+
+    def ctr_cipher(self, key, iv):
+        return AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=bytes(iv))
+
+    def ofb(self, key, iv, data):
+        return AES.new(key, AES.MODE_OFB, bytes(iv)).decrypt(data)
+
+# cryptography's contexts only have update(), give them the pycryptodome names
+class CryptographyCipher():
+    def __init__(self, context):
+        self.context = context
+    def encrypt(self, data):
+        return self.context.update(data)
+    def decrypt(self, data):
+        return self.context.update(data)
+
+class CryptographyBackend(AESBackend):
+    name = "cryptography"
+
+    def ecb_encrypt(self, key, data):
+        return Cipher(algorithms.AES(key), modes.ECB()).encryptor().update(data)
+
+    def ctr_cipher(self, key, iv):
+        return CryptographyCipher(Cipher(algorithms.AES(key), modes.CTR(bytes(iv))).decryptor())
+
+# name -> backend class, cryptography only when it imported
+crypto_backends = {PycryptodomeBackend.name: PycryptodomeBackend}
+if Cipher is not None:
+    crypto_backends[CryptographyBackend.name] = CryptographyBackend
+
+# something shaped like a wak, mostly small xml/lua with the odd big png, seconds for one pass
+def bench_backend(backend, number=3):
+    rng = np.random.default_rng(0)
+    key = bytes(range(16))
+    sizes = np.clip(rng.lognormal(7, 1.2, 512).astype(np.int64), 1, 1 << 20)
+    datas = [bytes(int(s)) for s in sizes]
+    ivs = rng.integers(0, 256, size=(len(datas), 16), dtype=np.uint8)
+    best = None
+    for i in range(number):
+        time_start = time.perf_counter()
+        backend.ctr_many(key, ivs, datas)
+        for iv, data in zip(ivs[:64], datas[:64]):
+            backend.ctr(key, iv.tobytes(), data)
+        elapsed = time.perf_counter() - time_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# name -> backend instance, the benchmark only runs once per process
+crypto_backend_cache = {}
+
+def get_backend(name=None):
+    name = name or os.environ.get(backend_env) or None
+    if name is not None:
+        if name not in crypto_backends:
+            raise ValueError("unknown or unavailable crypto backend {}, expected one of {}".format(name, list(crypto_backends)))
+        if name not in crypto_backend_cache:
+            crypto_backend_cache[name] = crypto_backends[name]()
+        return crypto_backend_cache[name]
+
+    if None not in crypto_backend_cache:
+        candidates = [cls() for cls in crypto_backends.values()]
+        if len(candidates) == 1:
+            crypto_backend_cache[None] = candidates[0]
+        else:
+            crypto_backend_cache[None] = min(candidates, key=bench_backend)
+    return crypto_backend_cache[None]
+
+# every backend has to agree with plain pycryptodome, including IVs whose low half carries into the high half
+def testbackends():
+    passed = True
+    rng = np.random.default_rng()
+    key = rng.integers(0, 256, size=16, dtype=np.uint8).tobytes()
+    sizes = [0, 1, 15, 16, 17, 1000, ctr_batch_max_entry - 1, ctr_batch_max_entry, 200000]
+    datas = [rng.integers(0, 256, size=s, dtype=np.uint8).tobytes() for s in sizes]
+    ivs = rng.integers(0, 256, size=(len(datas), 16), dtype=np.uint8)
+    ivs[1] = np.frombuffer(bytes(8) + b"\xff"*8, dtype=np.uint8)
+    ivs[5] = 0xff
+    expected = [AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=iv.tobytes()).decrypt(d) for iv, d in zip(ivs, datas)]
+    header = AES.new(key, AES.MODE_OFB, ivs[2].tobytes()).decrypt(datas[3])
+    for name, cls in crypto_backends.items():
+        backend = cls()
+        ok = backend.ctr_many(key, ivs, datas) == expected
+        ok = ok and list(backend.ctr_iter(key, zip([iv.tobytes() for iv in ivs], datas), batch_size=1024)) == expected
+        ok = ok and [backend.ctr(key, iv.tobytes(), d) for iv, d in zip(ivs, datas)] == expected
+        ok = ok and backend.ofb(key, ivs[2].tobytes(), datas[3]) == header
+        cipher = backend.ctr_cipher(key, ivs[8].tobytes())
+        ok = ok and cipher.decrypt(datas[8][:1000]) + cipher.decrypt(datas[8][1000:]) == expected[8]
+        print("crypto backend test {}: {}".format("passed" if ok else "failed", name))
+        passed = passed and ok
+    return passed
+
+if __name__ == "__main__":
+    passed = testbackends()
+    for name, cls in crypto_backends.items():
+        print("[bench] {:12s} {:.2f} ms".format(name, bench_backend(cls())*1e3))
+    print("[+] get_backend() picks {}".format(get_backend().name))
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# who-loads-what between the scripts and entities of a wak, saved per build so the datawak_tree.txt diff between two
+# builds can go straight from changed files to everything they can affect.
+#
+#   python3 wakdeps.py -w data.wak -g luadeps.npz                       # build and save
+#   python3 wakdeps.py -g luadeps.npz --loaders data/scripts/lib.lua    # what loads it
+#   python3 wakdeps.py -g luadeps.npz --trees old/datawak_tree.txt new/datawak_tree.txt   # what changed, and what that touches
+#
+# an edge src -> dst means loading src loads dst:
+#   dofile/dofile_once    lua -> lua, string literal paths only
+#   append                ModLuaFileAppend(target, appended) makes target -> appended
+#   component             LuaComponent script_* in an xml -> lua
+#   base                  <Base file=...> in an xml -> xml, so a script change reaches every entity built on it
+import sys, argparse, time, re
+from pathlib import Path
+
+import numpy as np
+
+from wakparsing import *
+
+
+edge_kinds = ["dofile", "dofile_once", "append", "component", "base"]
+
+lua_comment_re = re.compile(rb"--\[(=*)\[.*?\]\1\]|--[^\n]*", re.S)
+dofile_re = re.compile(rb"\b(dofile|dofile_once)\s*\(\s*[\"']([^\"'\n]+)[\"']\s*\)")
+append_re = re.compile(rb"\bModLuaFileAppend\s*\(\s*[\"']([^\"'\n]+)[\"']\s*,\s*[\"']([^\"'\n]+)[\"']\s*\)")
+xml_comment_re = re.compile(rb"<!--.*?-->", re.S)
+lua_component_re = re.compile(rb"<LuaComponent\b([^>]*)>")
+script_attr_re = re.compile(rb"\b(script_\w+)\s*=\s*\"([^\"]+)\"")
+base_re = re.compile(rb"<Base\b[^>]*\bfile\s*=\s*\"([^\"]+)\"")
+
+def normalize_path(path):
+    path = path.decode("utf-8", "replace").strip().replace("\\", "/")
+    while path.startswith("./"):
+        path = path[2:]
+    return path
+
+# (src, dst, kind) edges found in one file's plaintext
+def file_edges(path, data):
+    edges = []
+    if path.endswith(".lua"):
+        data = lua_comment_re.sub(b"", data)
+        for call, target in dofile_re.findall(data):
+            edges.append((path, normalize_path(target), call.decode()))
+        for target, appended in append_re.findall(data):
+            edges.append((normalize_path(target), normalize_path(appended), "append"))
+    elif path.endswith(".xml"):
+        data = xml_comment_re.sub(b"", data)
+        for attrs in lua_component_re.findall(data):
+            for name, script in script_attr_re.findall(attrs):
+                if script.strip():
+                    edges.append((path, normalize_path(script), "component"))
+        for base in base_re.findall(data):
+            edges.append((path, normalize_path(base), "base"))
+    return edges
+
+# adjacency in both directions as CSR arrays, paths are node ids in order of first appearance
+class LuaDepGraph():
+    def __init__(self, paths, src, dst, kind):
+        self.paths = list(paths)
+        self.path_index = {p: i for i, p in enumerate(self.paths)}
+        self.src = np.asarray(src, dtype=np.int32)
+        self.dst = np.asarray(dst, dtype=np.int32)
+        self.kind = np.asarray(kind, dtype=np.uint8)
+        self.fwd_indptr, self.fwd = self.csr(self.src)
+        self.rev_indptr, self.rev = self.csr(self.dst)
+
+    # (indptr, edge ids) with the edges of node n at edge ids[indptr[n]:indptr[n+1]]
+    def csr(self, keys):
+        order = np.argsort(keys, kind="stable").astype(np.int32)
+        indptr = np.zeros(len(self.paths) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(self.paths)), out=indptr[1:])
+        return indptr, order
+
+    @classmethod
+    def from_edges(cls, edges):
+        paths, path_index = [], {}
+        def node(p):
+            if p not in path_index:
+                path_index[p] = len(paths)
+                paths.append(p)
+            return path_index[p]
+        edges = sorted(set(edges))
+        src = [node(s) for s, d, k in edges]
+        dst = [node(d) for s, d, k in edges]
+        kind = [edge_kinds.index(k) for s, d, k in edges]
+        return cls(paths, src, dst, kind)
+
+    # every .lua and .xml in the wak, decrypted in batches and scanned with regexes, nothing gets parsed
+    @classmethod
+    def from_wak(cls, wak):
+        entries = [f for f in wak.file_list if f.path.endswith((".lua", ".xml"))]
+        edges = []
+        for f, fdata_dec in wak.decrypt_entries(entries):
+            edges.extend(file_edges(f.path, fdata_dec))
+        return cls.from_edges(edges)
+
+    def save(self, path):
+        names = "\x00".join(self.paths).encode()
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, names=np.frombuffer(names, dtype=np.uint8), src=self.src, dst=self.dst, kind=self.kind)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            names = data["names"].tobytes().decode()
+            return cls(names.split("\x00") if names else [], data["src"], data["dst"], data["kind"])
+
+    def __len__(self):
+        return len(self.src)
+
+    # [(other path, kind)] of the edges into (reverse=True) or out of path
+    def neighbours(self, path, reverse=False):
+        n = self.path_index.get(path)
+        if n is None:
+            return []
+        indptr, order, other = (self.rev_indptr, self.rev, self.src) if reverse else (self.fwd_indptr, self.fwd, self.dst)
+        ids = order[indptr[n]:indptr[n+1]]
+        return [(self.paths[other[e]], edge_kinds[self.kind[e]]) for e in ids]
+
+    # what loads path directly
+    def loaders(self, path):
+        return self.neighbours(path, reverse=True)
+
+    # what path loads directly
+    def loads(self, path):
+        return self.neighbours(path)
+
+    # every file that loads any of paths, directly or through others, not counting paths themselves unless
+    # they load each other
+    def affected(self, paths):
+        seen = np.zeros(len(self.paths), dtype=bool)
+        todo = [self.path_index[p] for p in paths if p in self.path_index]
+        while len(todo) > 0:
+            n = todo.pop()
+            for e in self.rev[self.rev_indptr[n]:self.rev_indptr[n+1]]:
+                s = self.src[e]
+                if not seen[s]:
+                    seen[s] = True
+                    todo.append(s)
+        return {self.paths[n] for n in np.flatnonzero(seen)}
+
+# {path: sha1} out of a datawak_tree.txt, paths get their data/ back since the tree leaves it off
+def read_tree(tree_path, root="data"):
+    result = {}
+    with open(tree_path, 'r') as f:
+        for line in f:
+            path, _, digest = line.rstrip("\n").rpartition(" ")
+            if digest != "dir" and path:
+                result["{}/{}".format(root, path.replace("\\", "/"))] = digest
+    return result
+
+# paths added, removed or modified between two datawak_tree.txt files
+def changed_between_trees(old_tree_path, new_tree_path):
+    old, new = read_tree(old_tree_path), read_tree(new_tree_path)
+    return sorted(p for p in set(old) | set(new) if old.get(p) != new.get(p))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Script/entity load graph of a data.wak.")
+    ap.add_argument('-g', dest='graph', required=True, type=Path, help='Graph file, written with -w, read otherwise. ex: luadeps.npz')
+    ap.add_argument('-w', dest='wak_file', type=Path, help='Build the graph from this data.wak and save it to -g.')
+    ap.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap.add_argument('--loaders', action='append', default=[], help='List what loads this file directly.')
+    ap.add_argument('--loads', action='append', default=[], help='List what this file loads directly.')
+    ap.add_argument('--affected', action='append', default=[], help='List everything that loads this file, directly or not.')
+    ap.add_argument('--trees', nargs=2, type=Path, metavar=('OLD_TREE', 'NEW_TREE'), help='Files that changed between two datawak_tree.txt, and everything they affect.')
+    args = ap.parse_args()
+
+    if args.wak_file is not None:
+        try:
+            with open_wak(args.wak_file, args.noita_version) as wak:
+                time_start = time.time()
+                graph = LuaDepGraph.from_wak(wak)
+        except WAKError as err:
+            print("[:(] {}".format(err))
+            sys.exit(1)
+        graph.save(args.graph)
+        print("[+] {} files, {} edges in {:.2f}s, saved to {}".format(len(graph.paths), len(graph), time.time() - time_start, args.graph))
+    else:
+        graph = LuaDepGraph.load(args.graph)
+
+    for path in args.loaders:
+        for other, kind in graph.loaders(path):
+            print("{} {}".format(kind, other))
+    for path in args.loads:
+        for other, kind in graph.loads(path):
+            print("{} {}".format(kind, other))
+    if args.affected:
+        for other in sorted(graph.affected(args.affected)):
+            print(other)
+    if args.trees is not None:
+        changed = changed_between_trees(*args.trees)
+        for path in changed:
+            print("changed {}".format(path))
+        for path in sorted(graph.affected(changed) - set(changed)):
+            print("affected {}".format(path))
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# inverted index of the text in every build's data.wak, so "which lua calls EntityLoad on this file" and
+# "when did this string show up" are a query instead of extracting builds and grepping them.
+#
+#   python3 wakindex.py index.sqlite add 881100_4336782_noitabeta data.wak
+#   python3 wakindex.py index.sqlite search EntityLoad data/entities/animals/boss_centipede/boss_centipede.xml -e .lua
+#   python3 wakindex.py index.sqlite search "Sampo" --first
+#
+# files are indexed by the sha1 of their plaintext, so a build only tokenizes the files that changed since any
+# earlier build. everything lives in one sqlite file.
+import sys, argparse, time, re, hashlib, sqlite3
+from pathlib import Path, PurePosixPath
+
+from wakparsing import *
+
+
+index_extensions = (".lua", ".xml", ".csv", ".txt")
+
+# identifiers/words, and anything path-shaped as a whole so a full path can be looked up in one go
+word_re = re.compile(rb"[A-Za-z0-9_]+")
+path_re = re.compile(rb"[A-Za-z0-9_.\-]*/[A-Za-z0-9_./\-]+")
+
+# lowercased set of terms in data, queries go through the same thing
+def tokenize(data):
+    if isinstance(data, str):
+        data = data.encode()
+    terms = set(word_re.findall(data))
+    terms.update(path_re.findall(data))
+    return {t.decode("utf-8", "replace").lower() for t in terms}
+
+def is_indexed_path(path):
+    return PurePosixPath(path).suffix.lower() in index_extensions
+
+index_schema = """
+CREATE TABLE IF NOT EXISTS builds (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, indexed_at REAL);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, sha1 TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS postings (term_id INTEGER NOT NULL, doc_id INTEGER NOT NULL, PRIMARY KEY (term_id, doc_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (build_id INTEGER NOT NULL, path TEXT NOT NULL, doc_id INTEGER NOT NULL, PRIMARY KEY (build_id, path)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_doc ON files (doc_id);
+"""
+
+# index = WAKIndex("archive/wakindex.sqlite")
+# index.add_build("881100_4336782_noitabeta", wak)
+# index.search("EntityLoad data/entities/x.xml", ext=".lua") -> [(build, path)]
+class WAKIndex():
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db = sqlite3.connect(str(self.db_path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(index_schema)
+
+    def close(self):
+        self.db.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    # build names in the order they were indexed
+    def builds(self):
+        return [name for (name,) in self.db.execute("SELECT name FROM builds ORDER BY id")]
+
+    def has_build(self, name):
+        return self.db.execute("SELECT 1 FROM builds WHERE name = ?", (name,)).fetchone() is not None
+
+    def remove_build(self, name):
+        with self.db:
+            row = self.db.execute("SELECT id FROM builds WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return
+            self.db.execute("DELETE FROM files WHERE build_id = ?", row)
+            self.db.execute("DELETE FROM builds WHERE id = ?", row)
+            # docs no build has any more, and their postings, so they don't turn up in searches or take up space.
+            # one pass over postings, it has no index on doc_id
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS orphans (doc_id INTEGER PRIMARY KEY)")
+            self.db.execute("DELETE FROM orphans")
+            self.db.execute("INSERT INTO orphans (doc_id) SELECT id FROM docs WHERE NOT EXISTS (SELECT 1 FROM files WHERE files.doc_id = docs.id)")
+            self.db.execute("DELETE FROM postings WHERE doc_id IN (SELECT doc_id FROM orphans)")
+            self.db.execute("DELETE FROM docs WHERE id IN (SELECT doc_id FROM orphans)")
+
+    # index the text entries of a WAKParser as build name. returns (files, newly tokenized files),
+    # None if the build is already in and replace is False
+    def add_build(self, name, wak, replace=False):
+        if self.has_build(name):
+            if not replace:
+                return None
+            self.remove_build(name)
+
+        entries = [f for f in wak.file_list if is_indexed_path(f.path)]
+        docs = dict(self.db.execute("SELECT sha1, id FROM docs"))
+        terms = dict(self.db.execute("SELECT term, id FROM terms"))
+        next_doc = max(docs.values(), default=0) + 1
+        next_term = max(terms.values(), default=0) + 1
+        new_docs, new_terms, postings, files = [], [], [], []
+        for f, fdata_dec in wak.decrypt_entries(entries):
+            sha1 = hashlib.sha1(fdata_dec).hexdigest()
+            doc_id = docs.get(sha1)
+            if doc_id is None:
+                doc_id = docs[sha1] = next_doc
+                next_doc += 1
+                new_docs.append((doc_id, sha1))
+                for term in tokenize(fdata_dec):
+                    term_id = terms.get(term)
+                    if term_id is None:
+                        term_id = terms[term] = next_term
+                        next_term += 1
+                        new_terms.append((term_id, term))
+                    postings.append((term_id, doc_id))
+            files.append((f.path, doc_id))
+
+        with self.db:
+            build_id = self.db.execute("INSERT INTO builds (name, indexed_at) VALUES (?, ?)", (name, time.time())).lastrowid
+            self.db.executemany("INSERT INTO docs (id, sha1) VALUES (?, ?)", new_docs)
+            self.db.executemany("INSERT INTO terms (id, term) VALUES (?, ?)", new_terms)
+            self.db.executemany("INSERT INTO postings (term_id, doc_id) VALUES (?, ?)", postings)
+            self.db.executemany("INSERT INTO files (build_id, path, doc_id) VALUES (?, ?, ?)",
+                ((build_id, path, doc_id) for path, doc_id in files))
+        return len(files), len(new_docs)
+
+    # doc ids containing every term of query, None if a term was never seen
+    def matching_docs(self, query):
+        term_ids = []
+        for term in tokenize(query):
+            row = self.db.execute("SELECT id FROM terms WHERE term = ?", (term,)).fetchone()
+            if row is None:
+                return None
+            term_ids.append(row[0])
+        if len(term_ids) == 0:
+            return None
+        sql = " INTERSECT ".join(["SELECT doc_id FROM postings WHERE term_id = ?"]*len(term_ids))
+        return [doc_id for (doc_id,) in self.db.execute(sql, term_ids)]
+
+    # [(build, path)] of files that contain every word/path in query, in build order then path.
+    # build limits it to one build, ext to files ending in it (ex: ".lua")
+    def search(self, query, build=None, ext=None):
+        doc_ids = self.matching_docs(query)
+        if not doc_ids:
+            return []
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS hits (doc_id INTEGER PRIMARY KEY)")
+        self.db.execute("DELETE FROM hits")
+        self.db.executemany("INSERT INTO hits (doc_id) VALUES (?)", ((d,) for d in doc_ids))
+        sql = "SELECT builds.name, files.path FROM hits JOIN files ON files.doc_id = hits.doc_id JOIN builds ON builds.id = files.build_id"
+        where, args = [], []
+        if build is not None:
+            where.append("builds.name = ?")
+            args.append(build)
+        if ext:
+            # not LIKE, _ and % in ext would be wildcards
+            where.append("substr(files.path, -length(?)) = ?")
+            args.extend([ext, ext])
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        return list(self.db.execute(sql + " ORDER BY builds.id, files.path", args))
+
+    # {path: first build it matched in}, for "when did this show up"
+    def first_seen(self, query, ext=None):
+        result = {}
+        for build, path in self.search(query, ext=ext):
+            result.setdefault(path, build)
+        return result
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Full-text index of data.wak text files across builds.")
+    ap.add_argument('index', type=Path, help='Index database. ex: archive/wakindex.sqlite')
+    sub = ap.add_subparsers(dest='command')
+    ap_add = sub.add_parser('add', help='Index a build\'s data.wak.')
+    ap_add.add_argument('build', help='Name to index the build as. ex: 881100_4336782_noitabeta')
+    ap_add.add_argument('wak_file', type=Path, help='Path to the build\'s data.wak')
+    ap_add.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap_add.add_argument('-f', dest='replace', action='store_true', help='Reindex the build if it\'s already in.')
+    ap_search = sub.add_parser('search', help='Files containing every word/path given.')
+    ap_search.add_argument('query', nargs='+', help='Words or paths, case-insensitive. ex: EntityLoad data/entities/items/wand.xml')
+    ap_search.add_argument('-b', dest='build', help='Only search this build.')
+    ap_search.add_argument('-e', dest='ext', help='Only files ending in this. ex: -e .lua')
+    ap_search.add_argument('--first', action='store_true', help='Only print the first build each file matched in.')
+    sub.add_parser('builds', help='List indexed builds.')
+    args = ap.parse_args()
+
+    with WAKIndex(args.index) as index:
+        if args.command == 'add':
+            try:
+                with open_wak(args.wak_file, args.noita_version) as wak:
+                    time_start = time.time()
+                    counts = index.add_build(args.build, wak, args.replace)
+            except WAKError as err:
+                print("[:(] {}".format(err))
+                sys.exit(1)
+            if counts is None:
+                print("[?] {} is already indexed, -f to reindex it".format(args.build))
+            else:
+                print("[+] Indexed {}: {} files, {} new since earlier builds, {:.2f}s".format(args.build, *counts, time.time() - time_start))
+        elif args.command == 'search':
+            time_start = time.time()
+            query = " ".join(args.query)
+            if args.first:
+                for path, build in sorted(index.first_seen(query, args.ext).items(), key=lambda item: item[0]):
+                    print("{} {}".format(build, path))
+            else:
+                for build, path in index.search(query, args.build, args.ext):
+                    print("{} {}".format(build, path))
+            print("[+] {:.1f} ms".format((time.time() - time_start)*1e3), file=sys.stderr)
+        else:
+            for build in index.builds():
+                print(build)
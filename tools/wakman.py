@@ -1,131 +1,441 @@
 #!/usr/bin/python3
 # 3.7.4 64-bit
-import struct, sys, argparse
-from pathlib import Path
-from binascii import *
+import sys, argparse, os, time, heapq, json, hashlib, io, tarfile, zipfile, zlib
+from pathlib import Path, PurePath
+from collections import deque
+from multiprocessing import Pool, freeze_support
 
-import hexdump
 import numpy as np
-from Cryptodome.Cipher import AES
-from Cryptodome.Util import Counter
-from Cryptodome.Util.number import bytes_to_long
 
 from badprng import *
 from wakparsing import *
+from wakcrypto import get_backend
+from wakstore import BlobStore, remove_file
 
 
-def parse_datawak(in_path, ver):
+# ver=None works out the version from the header first
+def parse_datawak(in_path, ver=None):
+    if ver is None:
+        versions = probe_wak_versions(in_path)
+        if len(versions) == 0:
+            raise WAKVersionError("{} doesn't decrypt as any of versions {}".format(in_path, list(noita_versions.values())))
+        ver = versions[0]
+        print("[+] Detected version {}".format(ver))
     print("[+] Parsing \"{}\"".format(in_path))
-    datawak_contents = None
-    with open(in_path, 'rb') as f:
-        datawak_contents = f.read()
+    # mmapped, entries are sliced out of the page cache as they're decrypted
+    parser = WAKParser(Path(in_path), ver)
 
-    parser = WAKParser(datawak_contents, ver)
-    
     return parser
 
-def extract_files(wak, out_dir, extract=True):
+# parse_datawak, but if ver doesn't decrypt the table we probe for the right one instead
+def parse_datawak_any(in_path, ver=None):
+    if ver is not None:
+        try:
+            return parse_datawak(in_path, ver)
+        except WAKDecryptError as err:
+            print("[:(] parsing as version {} failed ({}), detecting it instead...".format(ver, err))
+    return parse_datawak(in_path)
+
+# plaintexts of the (path, offset, size, tblidx) entries of batch in order, read from wak_file as they're needed.
+# goes through ctr_iter, so the small entries in a batch share their cipher setup
+def decrypt_batch_iter(wak_file, prng, batch):
+    ivs = prng.badprng_get16_many([0x165EC8F+tblidx for path, offset, size, tblidx in batch])
+    def read_entries():
+        for (path, offset, size, tblidx), f_iv in zip(batch, ivs):
+            wak_file.seek(offset)
+            yield f_iv, wak_file.read(size)
+    return get_backend().ctr_iter(prng.default_key, read_entries())
+
+# sha1 for datawak_tree.txt and the store, crc32 as a cheap check, both while the plaintext is still in memory
+def hash_entry(fdata_dec):
+    return hashlib.sha1(fdata_dec).hexdigest(), zlib.crc32(fdata_dec)
+
+# with a store the plaintext goes into it and out_dir gets a hardlink. returns (sha1, crc32) of the plaintext
+def write_entry(out_dir, path, fdata_dec, store=None):
+    digests = hash_entry(fdata_dec)
+    if store is not None:
+        store.put(fdata_dec, digests[0])
+        store.link(digests[0], out_dir / path)
+        return digests
+
+    out_filepath = (out_dir / path).resolve()
+    if not out_filepath.parent.is_dir():
+        out_filepath.parent.mkdir(parents=True, exist_ok=True)
+    elif out_filepath.is_file() and out_filepath.stat().st_nlink > 1:
+        # probably linked to a store blob by an earlier -s extraction, don't write through it
+        remove_file(out_filepath)
+    out_filepath.write_bytes(fdata_dec)
+    return digests
+
+# split entries into n batches of roughly equal total size, biggest files first onto the lightest batch
+def balance_batches(entries, n):
+    n = max(n, 1)
+    batches = [[] for i in range(n)]
+    heap = [(0, i) for i in range(n)]
+    for f in sorted(entries, key=lambda f: f.size, reverse=True):
+        load, i = heapq.heappop(heap)
+        batches[i].append((f.path, f.offset, f.size, f.tblidx))
+        heapq.heappush(heap, (load + f.size, i))
+    return [b for b in batches if len(b) > 0]
+
+# runs in a worker process, gets the wak path + offsets so we never pickle file contents
+def extract_batch(wak_path, ver, out_dir, batch, store_root=None):
+    time_start = time.time()
+    prng = BadPRNG(ver)
+    store = BlobStore(store_root) if store_root is not None else None
+    total_size = 0
+    digests = {}
+    with open(wak_path, 'rb') as wak_file:
+        for (path, offset, size, tblidx), fdata_dec in zip(batch, decrypt_batch_iter(wak_file, prng, batch)):
+            digests[path] = write_entry(out_dir, path, fdata_dec, store)
+            total_size += size
+    return (os.getpid(), len(batch), total_size, time.time() - time_start, digests)
+
+def extract_files_parallel(wak, out_dir, jobs, entries, store=None, log=print):
+    batches = balance_batches(entries, jobs)
+    store_root = store.root if store is not None else None
+    log("[+] Extracting with {} workers".format(len(batches)))
+    with Pool(len(batches)) as pool:
+        results = pool.starmap(extract_batch, [(wak.datawak_path, wak.prng.ver, out_dir, b, store_root) for b in batches])
+    digests = {}
+    for pid, count, total_size, elapsed, batch_digests in results:
+        log("[+] worker {}: {} files, {:.2f} MB in {:.2f}s ({:.2f} MB/s)".format(
+            pid, count, total_size/1e6, elapsed, total_size/1e6/max(elapsed, 1e-9)))
+        digests.update(batch_digests)
+    return digests
+
+# runs in a worker process, sha1 of the plaintext of every entry in batch
+def hash_batch(wak_path, ver, batch):
+    prng = BadPRNG(ver)
+    result = []
+    with open(wak_path, 'rb') as wak_file:
+        for (path, offset, size, tblidx), fdata_dec in zip(batch, decrypt_batch_iter(wak_file, prng, batch)):
+            result.append((path, hashlib.sha1(fdata_dec).hexdigest()))
+    return result
+
+def hash_files(wak, entries, jobs):
+    batches = balance_batches(entries, jobs)
+    if len(batches) == 0:
+        return {}
+    if len(batches) == 1:
+        return dict(hash_batch(wak.datawak_path, wak.prng.ver, batches[0]))
+    with Pool(len(batches)) as pool:
+        results = pool.starmap(hash_batch, [(wak.datawak_path, wak.prng.ver, b) for b in batches])
+    return dict(r for batch_result in results for r in batch_result)
+
+# compare two waks' tables, returns sorted lists of (added, removed, modified) paths.
+# same size+IV+ciphertext is the same file, different sizes are always different,
+# everything else gets its plaintext hashed on both sides.
+def diff_waks(old_wak, new_wak, jobs=1):
+    old_list, new_list = old_wak.file_list, new_wak.file_list
+    added   = sorted(p for p in new_list.paths if p not in old_list)
+    removed = sorted(p for p in old_list.paths if p not in new_list)
+    modified = []
+    old_ivs, new_ivs = old_wak.entry_ivs(), new_wak.entry_ivs()
+    old_to_hash, new_to_hash = [], []
+    for fn in new_list:
+        fo = old_list.get(fn.path)
+        if fo is None:
+            continue
+        if fo.size != fn.size:
+            modified.append(fn.path)
+        elif (old_ivs[fo.tblidx] == new_ivs[fn.tblidx]).all() and old_wak.entry_data(fo) == new_wak.entry_data(fn):
+            continue
+        else:
+            old_to_hash.append(fo)
+            new_to_hash.append(fn)
+
+    old_hashes = hash_files(old_wak, old_to_hash, jobs)
+    new_hashes = hash_files(new_wak, new_to_hash, jobs)
+    modified.extend(p for p in new_hashes if old_hashes[p] != new_hashes[p])
+    return added, removed, sorted(modified)
+
+# runs in a worker process, decrypted contents of every entry in batch, in batch order
+def decrypt_batch(wak_path, ver, batch):
+    prng = BadPRNG(ver)
+    with open(wak_path, 'rb') as wak_file:
+        return list(decrypt_batch_iter(wak_file, prng, batch))
+
+# consecutive runs of entries up to max_size bytes each (or one bigger entry)
+def contiguous_batches(entries, max_size):
+    batch, batch_size = [], 0
+    for f in entries:
+        if len(batch) > 0 and batch_size + f.size > max_size:
+            yield batch
+            batch, batch_size = [], 0
+        batch.append((f.path, f.offset, f.size, f.tblidx))
+        batch_size += f.size
+    if len(batch) > 0:
+        yield batch
+
+# (path, plaintext) for entries (default: all of them) in order. with jobs > 1 workers decrypt batches ahead of us,
+# but never more than 2 per worker so memory stays bounded no matter how slow the consumer is.
+decrypt_batch_size = 8*1024*1024
+def iter_decrypted(wak, jobs=1, entries=None):
+    entries = wak.file_list if entries is None else entries
+    if jobs <= 1 or wak.datawak_path is None:
+        for f, fdata_dec in wak.decrypt_entries(entries):
+            yield f.path, fdata_dec
+        return
+
+    with Pool(jobs) as pool:
+        pending = deque()
+        def next_done():
+            batch, result = pending.popleft()
+            return zip([path for path, offset, size, tblidx in batch], result.get())
+        for batch in contiguous_batches(entries, decrypt_batch_size):
+            pending.append((batch, pool.apply_async(decrypt_batch, (wak.datawak_path, wak.prng.ver, batch))))
+            if len(pending) >= 2*jobs:
+                yield from next_done()
+        while len(pending) > 0:
+            yield from next_done()
+
+# datawak_tree.txt as GameParserNoitaRuntimeAnalysis.get_tree would write it for the unpacked tree,
+# but from the hashes we took while decrypting. paths are relative to root, dirs get a "<dir> dir" line.
+def wak_tree(digests, root="data"):
+    result = set()
+    for path, digest in digests.items():
+        rel_name = PurePath(path)
+        if rel_name.parts[0] == root:
+            rel_name = PurePath(*rel_name.parts[1:])
+        result.add("{} {}".format(rel_name, digest))
+        for parent in list(rel_name.parents)[:-1]:
+            result.add("{} dir".format(parent))
+    return sorted(result)
+
+def write_tree(tree_path, digests):
+    with open(tree_path, 'w') as f:
+        f.write('\n'.join(wak_tree(digests)))
+    print("[+] Wrote tree of {} files to {}".format(len(digests), tree_path))
+
+# what we extracted last time, {path: {"size": n, "hash": sha1 of iv+ciphertext, "sha1": sha1, "crc32": crc32}}
+# hash decides whether we have to extract again, sha1/crc32 are of the plaintext (and sha1 is its blob in a store)
+# same ciphertext under a different IV is different plaintext, so the IV goes into the hash too.
+manifest_name = "wakman_manifest.json"
+
+def load_manifest(out_dir):
+    manifest_path = out_dir / manifest_name
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)["files"]
+    except (ValueError, KeyError) as err:
+        print("[?] Ignoring unreadable manifest {}: {}".format(manifest_path, err))
+        return {}
+
+def save_manifest(out_dir, manifest):
+    manifest_path = out_dir / manifest_name
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({"files": manifest}, f, indent=0, sort_keys=True)
+    os.replace(str(tmp_path), str(manifest_path))
+
+def entry_manifest(wak, f, f_iv):
+    h = hashlib.sha1(f_iv)
+    h.update(wak.entry_data(f))
+    return {"size": f.size, "hash": h.hexdigest()}
+
+# with a store, out_dir only gets hardlinks and the build's manifest is saved in the store as build_name.
+# tree_path gets a datawak_tree.txt built from the hashes taken during extraction, nothing is read back.
+# verbose=False keeps it off stdout entirely, for callers that log their own summary
+def extract_files(wak, out_dir, extract=True, jobs=1, incremental=True, store=None, build_name=None, tree_path=None, verbose=True):
+    log = print if verbose else (lambda *args: None)
     out_dir = Path(out_dir)
     if extract:
-        print("[+] Extracting to {}".format(out_dir))
+        log("[+] Extracting to {}".format(out_dir))
         if not out_dir.is_dir():
             out_dir.mkdir(parents=True, exist_ok=True)
 
-    # multiprocessing this
     for f in wak.file_list:
-        print("{:.50s}:[offs {:08X}][size {:08X}][pthl {:08X}]".format(f.path, f.offset, f.size, f.pathlen))
-        if extract:
-            fdata = wak.datawak_contents[f.offset:f.offset+f.size]
-            f_iv = wak.prng.badprng_get16(0x165EC8F+f.tblidx)
-
-            c = Counter.new(128, initial_value=bytes_to_long(f_iv))
-            fdata_dec = AES.new(wak.prng.default_key, AES.MODE_CTR, counter=c).decrypt(fdata)
-
-            out_filepath = (out_dir / f.path).resolve()
-            if not out_filepath.parent.is_dir():
-                out_filepath.parent.mkdir(parents=True, exist_ok=True)
-            out_filepath.write_bytes(fdata_dec)
-    print("[+] Complete, iterated {} files.".format(len(wak.file_list)))
-
-# scrape registry if the user didn't tell us where their wak is
-def find_datawak_registry() -> Path:
-    # if you've recently launched noita
-    try:
-        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Classes\Local Settings\Software\Microsoft\Windows\Shell\MuiCache', 0, winreg.KEY_READ)
-
-        for i in range(0, winreg.QueryInfoKey(key)[1]):
-            val = winreg.EnumValue(key, i)
-            if "noita" in val[0].lower():
-                noita_dir = Path(val[0]).parent
-                if (noita_dir / "data/data.wak").is_file():
-                    return noita_dir / "data/data.wak"
-    except (KeyboardInterrupt):
-        raise
-    except:
-        pass
-    
-    # if you ever launched it from a random location, abuse the fact that the game is WOW64
-    try:
-        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Microsoft\Windows NT\CurrentVersion\AppCompatFlags\Compatibility Assistant\Store', 0, winreg.KEY_READ)
-
-        for i in range(0, winreg.QueryInfoKey(key)[1]):
-            val = winreg.EnumValue(key, i)
-            if "noita" in val[0].lower():
-                noita_dir = Path(val[0]).parent
-                if (noita_dir / "data/data.wak").is_file():
-                    return noita_dir / "data/data.wak"
-    except (KeyboardInterrupt):
-        raise
-    except:
-        pass
-
-    # if you browsed to a folder with Noita in the name
-    try:
-        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Microsoft\Windows\CurrentVersion\Explorer\TypedPaths', 0, winreg.KEY_READ)
-
-        for i in range(0, winreg.QueryInfoKey(key)[1]):
-            val = winreg.EnumValue(key, i)
-            if "noita" in val[1].lower():
-                noita_dir = Path(val[1]).parent
-                for p in ["data/data.wak", "data.wak"]:
-                    if (noita_dir / p).is_file():
-                        return noita_dir / p
-    except (KeyboardInterrupt):
-        raise
-    except:
-        pass
-    
-    return None
-
-def find_datawak():
-    test_paths = [
-        Path('data.wak'),
-        Path('data/data.wak'),
-        Path(r'C:\Program Files (x86)\Steam\steamapps\common\Noita\data\data.wak'),
-        Path.home() / '.local/share/Steam/steamapps/common/Noita/data/data.wak'
-    ]
-    for path in test_paths:
-        if path.is_file():
-            return path
-
-    import os
-    if os.name == 'nt':
-        path = find_datawak_registry()
-        if path:
-            return path
-    
-    print("[:(] exiting, couldn't find data.wak in default locations: {}".format(test_paths))
-    exit(1)
+        log("{:.50s}:[offs {:08X}][size {:08X}][pthl {:08X}]".format(f.path, f.offset, f.size, f.pathlen))
+
+    if extract:
+        ivs = wak.entry_ivs()
+        old_manifest = load_manifest(out_dir) if incremental else {}
+        manifest = {}
+        todo = []
+        for f in wak.file_list:
+            manifest[f.path] = entry_manifest(wak, f, ivs[f.tblidx].tobytes())
+            old_entry = old_manifest.get(f.path, {})
+            if old_entry.get("hash") != manifest[f.path]["hash"] or not (out_dir / f.path).is_file():
+                todo.append(f)
+            elif "sha1" not in old_entry or "crc32" not in old_entry:
+                todo.append(f)
+            elif store is not None and not store.has(old_entry["sha1"]):
+                todo.append(f)
+            else:
+                manifest[f.path]["sha1"] = old_entry["sha1"]
+                manifest[f.path]["crc32"] = old_entry["crc32"]
+
+        # only touch what we put there ourselves
+        removed = [p for p in old_manifest if p not in manifest]
+        for p in removed:
+            old_filepath = out_dir / p
+            if old_filepath.is_file():
+                remove_file(old_filepath)
+        if len(old_manifest) > 0:
+            log("[+] {} unchanged, {} changed or new, {} removed".format(len(manifest) - len(todo), len(todo), len(removed)))
+
+        # workers reopen the wak themselves, so we can only fan out if we know where it lives
+        digests = {}
+        if jobs > 1 and wak.datawak_path is not None and len(todo) > 0:
+            digests = extract_files_parallel(wak, out_dir, jobs, todo, store, log)
+        else:
+            for f, fdata_dec in wak.decrypt_entries(todo, [ivs[f.tblidx] for f in todo]):
+                digests[f.path] = write_entry(out_dir, f.path, fdata_dec, store)
+
+        for path, (sha1, crc32) in digests.items():
+            manifest[path]["sha1"] = sha1
+            manifest[path]["crc32"] = crc32
+        if store is not None:
+            build_name = build_name or out_dir.name
+            store.save_manifest(build_name, {path: entry["sha1"] for path, entry in manifest.items()})
+            log("[+] Stored {} as {} in {}".format(len(manifest), build_name, store.root))
+        save_manifest(out_dir, manifest)
+        if tree_path is not None:
+            write_tree(tree_path, {path: entry["sha1"] for path, entry in manifest.items()})
+    log("[+] Complete, iterated {} files.".format(len(wak.file_list)))
+
+# decrypt straight into a single .tar/.zip, or a tar on stdout when out is "-".
+# one sequential write through one buffer instead of a mkdir+write per entry.
+archive_buffer_size = 1024*1024
+def is_archive_output(out):
+    return str(out) == "-" or Path(out).suffix.lower() in (".tar", ".zip")
+
+def extract_files_archive(wak, out, jobs=1, tree_path=None):
+    if str(out) == "-":
+        out_stream = os.fdopen(sys.__stdout__.fileno(), 'wb', buffering=archive_buffer_size, closefd=False)
+    else:
+        out_stream = open(out, 'wb', buffering=archive_buffer_size)
+    # every entry gets the wak's timestamp, same wak in means same archive out
+    mtime = wak.datawak_path.stat().st_mtime if wak.datawak_path is not None else time.time()
+
+    digests = {}
+    with out_stream:
+        if str(out) != "-" and Path(out).suffix.lower() == ".zip":
+            with zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_STORED) as archive:
+                date_time = time.localtime(max(mtime, 315532800))[0:6] # zip can't go before 1980
+                for path, fdata_dec in iter_decrypted(wak, jobs):
+                    archive.writestr(zipfile.ZipInfo(path, date_time), fdata_dec)
+                    digests[path] = hashlib.sha1(fdata_dec).hexdigest()
+        else:
+            with tarfile.open(fileobj=out_stream, mode='w|') as archive:
+                for path, fdata_dec in iter_decrypted(wak, jobs):
+                    info = tarfile.TarInfo(path)
+                    info.size = len(fdata_dec)
+                    info.mtime = int(mtime)
+                    archive.addfile(info, io.BytesIO(fdata_dec))
+                    digests[path] = hashlib.sha1(fdata_dec).hexdigest()
+    if tree_path is not None:
+        write_tree(tree_path, digests)
+    print("[+] Complete, wrote {} files to {}.".format(len(digests), out))
+
+# argparse type for -j, 0 or less workers would leave balance_batches nothing to put entries into
+def jobs_count(value):
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("needs at least 1 worker, got {}".format(value))
+    return jobs
+
+def main_diff(argv):
+    ap = argparse.ArgumentParser(prog="wakman.py diff", description="List files added (A), removed (D) and modified (M) between two waks without extracting them.")
+    ap.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap.add_argument('-j', dest='jobs', default=os.cpu_count(), type=jobs_count, help='Number of worker processes to hash changed files with.')
+    ap.add_argument('old_wak', type=Path, help='Path to the older data.wak')
+    ap.add_argument('new_wak', type=Path, help='Path to the newer data.wak')
+    args = ap.parse_args(argv)
+
+    old_wak = parse_datawak_any(args.old_wak.resolve(), args.noita_version)
+    new_wak = parse_datawak_any(args.new_wak.resolve(), args.noita_version)
+    added, removed, modified = diff_waks(old_wak, new_wak, args.jobs)
+    changes = [(p, "A") for p in added] + [(p, "D") for p in removed] + [(p, "M") for p in modified]
+    for path, change in sorted(changes):
+        print("{} {}".format(change, path))
+    print("[+] {} added, {} removed, {} modified".format(len(added), len(removed), len(modified)))
+    return 0
+
+def main_pack(argv):
+    ap = argparse.ArgumentParser(prog="wakman.py pack", description="Build a data.wak out of a folder, ex: one made by wakman.py -x")
+    ap.add_argument('-o', dest='out_wak', required=True, type=Path, help='data.wak to write. ex: -o C:\\noita\\data\\data.wak')
+    ap.add_argument('-m', dest='noita_version', default=max(noita_versions.values()), type=int, help='Version of noita to build the wak for. 1 is stable, before oct10. 2 is beta and after oct10.')
+    ap.add_argument('-j', dest='jobs', default=1, type=jobs_count, help='Number of worker processes to encrypt with. ex: -j 8')
+    ap.add_argument('in_dir', type=Path, help='Folder containing the data folder to pack.')
+    args = ap.parse_args(argv)
+
+    print("[+] Packing {} into {}".format(args.in_dir.resolve(), args.out_wak.resolve()))
+    writer = WAKWriter(args.noita_version, args.jobs)
+    count = writer.write(args.out_wak.resolve(), WAKWriter.entries_from_dir(args.in_dir.resolve(), skip=[manifest_name]))
+    print("[+] Complete, packed {} files.".format(count))
+    return 0
+
+def main_query(argv):
+    ap = argparse.ArgumentParser(prog="wakman.py query", description="Decrypt only the entries matching --include/--regex (all if omitted) and not --exclude.")
+    ap.add_argument('--include', action='append', default=[], help="Glob of paths to decrypt, * stays in one folder and ** crosses them. ex: 'data/entities/**/*.xml'")
+    ap.add_argument('--exclude', action='append', default=[], help="Glob of paths to skip even if they're included.")
+    ap.add_argument('--regex', action='append', default=[], help="Regex of paths to decrypt, matched from the start of the path.")
+    ap.add_argument('--format', dest='out_format', choices=['files', 'jsonl'], default='files', help='files extracts matches into -o, jsonl writes one line per match (path, offset, size, sha1) to -o.')
+    ap.add_argument('-o', dest='outloc', default="-", type=Path, help='Folder for --format files, file or - (stdout) for --format jsonl.')
+    ap.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap.add_argument('-j', dest='jobs', default=1, type=jobs_count, help='Number of worker processes to decrypt with.')
+    ap.add_argument('wak_file', type=Path, help='Path to your data.wak')
+    args = ap.parse_args(argv)
+
+    jsonl_stdout = args.out_format == 'jsonl' and str(args.outloc) == "-"
+    if jsonl_stdout:
+        sys.stdout = sys.stderr
+    if args.out_format == 'files' and str(args.outloc) == "-":
+        print("[:(] --format files needs a folder for -o")
+        return 1
+
+    wak = parse_datawak_any(args.wak_file.resolve(), args.noita_version)
+    entries = list(wak.file_list.select(args.include, args.exclude, args.regex))
+    print("[+] {} of {} entries match".format(len(entries), len(wak.file_list)))
+    entry_info = {f.path: f for f in entries}
+
+    if args.out_format == 'files':
+        out_dir = args.outloc.resolve()
+        for path, fdata_dec in iter_decrypted(wak, args.jobs, entries):
+            write_entry(out_dir, path, fdata_dec)
+    else:
+        if jsonl_stdout:
+            out = os.fdopen(sys.__stdout__.fileno(), 'w', buffering=archive_buffer_size, closefd=False)
+        else:
+            out = open(args.outloc, 'w', buffering=archive_buffer_size)
+        with out:
+            for path, fdata_dec in iter_decrypted(wak, args.jobs, entries):
+                f = entry_info[path]
+                out.write(json.dumps({"path": path, "offset": f.offset, "size": f.size, "sha1": hashlib.sha1(fdata_dec).hexdigest()}) + "\n")
+    print("[+] Complete, decrypted {} files.".format(len(entries)))
+    return 0
+
+subcommands = {
+    "diff": main_diff,
+    "pack": main_pack,
+    "query": main_query
+}
 
 if __name__ == '__main__':
+    freeze_support() # pyinstaller onefile builds need this for the -j workers
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        sys.exit(subcommands[sys.argv[1]](sys.argv[2:]))
+
     ap = argparse.ArgumentParser(description="On windows, please run: C:\\path\\to\your\python.exe wakman.py [args here]")
     ap.add_argument('-x', dest='extract', action='store_true', help='Extract the contents of a wak. Only lists contents if omitted.')
-    ap.add_argument('-o', dest='outloc', required=True, type=Path, help='Folder to extract wak to. ex: -o C:\\wak_extracted')
-    ap.add_argument('-m', dest='noita_version', default=1, type=int, help='Version of noita. 1 is stable, before oct10. 2 is beta and after oct10.')
+    ap.add_argument('-o', dest='outloc', required=True, type=Path, help='Folder to extract wak to, or a .tar/.zip to extract into, or - for a tar on stdout. ex: -o C:\\wak_extracted')
+    ap.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. 1 is stable, before oct10. 2 is beta and after oct10. Worked out from the header if omitted or wrong.')
+    ap.add_argument('-f', dest='full', action='store_true', help='Extract every file, even ones the last extraction to -o says are unchanged.')
+    ap.add_argument('-j', dest='jobs', default=1, type=jobs_count, help='Number of worker processes to extract with. ex: -j 8')
+    ap.add_argument('-s', dest='store', type=Path, help='Content-addressed store to extract into, -o only gets hardlinks to it. ex: -s C:\\wak_store')
+    ap.add_argument('-b', dest='build_name', help='Name of this build in the -s store. Defaults to the name of the -o folder.')
+    ap.add_argument('-t', dest='tree', type=Path, help='Also write a datawak_tree.txt style list of paths and sha1s while extracting. ex: -t datawak_tree.txt')
     ap.add_argument('wak_file', nargs='?', type=Path, help='Path to your data.wak. If omitted, wakman guesses.')
 
     try:
         args = ap.parse_args()
+        if str(args.outloc) == "-":
+            # stdout is the tar, everything we'd print goes to stderr
+            sys.stdout = sys.stderr
         print(vars(args))
     except SystemExit as err:
         print("\n")
@@ -134,10 +444,12 @@ if __name__ == '__main__':
         sys.exit(0)
 
     extract = False
+    store = BlobStore(args.store.resolve()) if args.store else None
 
-    if args.outloc:
+    archive_output = is_archive_output(args.outloc)
+    if args.outloc and str(args.outloc) != "-":
         args.outloc = args.outloc.resolve()
-        print("[+] Output directory: {}".format(args.outloc))
+        print("[+] Output {}: {}".format("archive" if archive_output else "directory", args.outloc))
     if args.extract:
         extract = True  
 
@@ -145,20 +457,23 @@ if __name__ == '__main__':
     if args.wak_file is None or not args.wak_file.is_file():
         if args.wak_file != None: 
             print('[?] Couldn’t find your WAK at "{}"'.format(args.wak_file))
-        args.wak_file = find_datawak().resolve()
+        try:
+            args.wak_file = find_datawak().resolve()
+        except WAKNotFoundError as err:
+            print("[:(] exiting, {}".format(err))
+            sys.exit(1)
         input('[+] Found a WAK at "{}", parse this WAK? (press any key to continue, ctrl+c to cancel)\n'.format(args.wak_file))
 
     args.wak_file = args.wak_file.resolve()
 
+    def run(wak):
+        if extract and archive_output:
+            extract_files_archive(wak, args.outloc, args.jobs, args.tree)
+        else:
+            extract_files(wak, args.outloc, extract, args.jobs, not args.full, store, args.build_name, args.tree)
+
     try:
-        wak = parse_datawak(args.wak_file, args.noita_version)
-        extract_files(wak, args.outloc, extract)
-    # UnicodeDecodeError should only occur if decryption failed, ValueError we throw in WAKParser
-    except (UnicodeDecodeError, ValueError):
-        print("[:(] extraction as version {} failed, trying another...".format(args.noita_version))
-        args.noita_version = (args.noita_version % len(noita_versions)) + 1
-        try:
-            wak = parse_datawak(args.wak_file, args.noita_version)
-            extract_files(wak, args.outloc, extract)
-        except (UnicodeDecodeError, ValueError) as err:
-            print(err)
+        run(parse_datawak_any(args.wak_file, args.noita_version))
+    except WAKError as err:
+        print("[:(] {}".format(err))
+        sys.exit(1)
@@ -1,67 +1,585 @@
 #!/usr/bin/python3
 # 3.7.4 64-bit
-import struct
+"""
+Read and write Noita's data.wak without going through wakman's CLI.
 
-from Cryptodome.Cipher import AES
-from Cryptodome.Util import Counter
-from Cryptodome.Util.number import bytes_to_long
+    from wakparsing import open_wak, find_datawak, WAKError
+
+    wak = open_wak(find_datawak())     # or a path/bytes, the PRNG version is worked out for you
+    wak.exists("data/scripts/init.lua")
+    wak.read_bytes("data/scripts/init.lua")
+    with wak.open("data/translations/common.csv") as f:
+        f.seek(100); f.read(50)        # only the blocks you read get decrypted
+
+    # lazily, plaintext is a memoryview. prefetch=n decrypts up to n entries ahead on threads
+    for entry, plaintext in wak.iter_entries(wak.file_list.select(include=["data/entities/**/*.xml"]), prefetch=8):
+        print(entry.path, entry.size, bytes(plaintext[0:16]))
+    for entry, plaintext in wak.decrypt_entries(entries):   # bytes, small entries share one AES call (see wakcrypto)
+        ...
+    wak.close()                        # or use it as a context manager
+
+    WAKWriter(ver).write("out.wak", [("data/x.txt", b"...")])
+
+`python3 wakparsing.py` writes waks with WAKWriter and checks every entry reads back the same.
+
+Everything raises a WAKError subclass instead of whatever went wrong inside:
+    WAKDecryptError  - the header or file table doesn't decrypt with this PRNG version (also a ValueError)
+    WAKVersionError  - open_wak tried every version and none of them decrypted it (also a ValueError)
+    WAKNotFoundError - no data.wak where we looked, or no such entry in it (also a FileNotFoundError)
+"""
+import sys, struct, mmap, io, tempfile, re, os
+from array import array
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from multiprocessing import Pool
 
 from badprng import *
+from wakcrypto import get_backend
+
+
+class WAKError(Exception):
+    pass
+class WAKDecryptError(WAKError, ValueError):
+    pass
+class WAKVersionError(WAKError, ValueError):
+    pass
+class WAKNotFoundError(WAKError, FileNotFoundError):
+    pass
 
+# "data/entities/**/*.xml" -> compiled regex for the whole path. * and ? stay inside one folder, ** crosses them.
+def glob_to_regex(pattern):
+    i, out = 0, []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and pattern.find("]", i+2) != -1:
+            end = pattern.find("]", i+2)
+            chars = pattern[i+1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            out.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return re.compile("".join(out) + r"\Z")
 
 # wakfiles = WAKFileList(buffer)
 # for file in wakfiles:
 #   print(file.path, file.offset, file.size, file.pathlen)
-# todo: make it a generator
+# file = wakfiles["data/scripts/init.lua"] # or wakfiles[tblidx]
 class WAKFileList():
+    # handed out on access, the table itself only keeps the columns below
     class WAKFile():
+        __slots__ = ("path", "offset", "size", "pathlen", "tblidx")
         def __init__(self, path, offset, size, pathlen, tblidx):
             self.path = path
             self.offset = offset
             self.size = size
             self.pathlen = pathlen
             self.tblidx = tblidx
-    
+
+    entry_header = struct.Struct("III")
+
     def __init__(self, buffer):
-        self.files = []
-        self.num = 0 # for iterator
+        buffer = memoryview(buffer)
+        self.offsets  = array('I')
+        self.sizes    = array('I')
+        self.pathlens = array('I')
+        path_blob = bytearray()
 
         curpos = 0
-        curidx = 0
         while curpos < len(buffer):
-            offset  = struct.unpack("I", buffer[curpos:curpos+4])[0]
-            size    = struct.unpack("I", buffer[curpos+4:curpos+8])[0]
-            pathlen = struct.unpack("I", buffer[curpos+8:curpos+12])[0]
-            path = buffer[curpos+12:curpos+12+pathlen].decode()
-            #IPython.embed()
-            self.files.append(self.WAKFile(path, offset, size, pathlen, curidx))
-
+            if curpos + 12 > len(buffer):
+                raise WAKDecryptError("ERROR: data.wak file table ends mid-entry, try a different value for -m")
+            offset, size, pathlen = self.entry_header.unpack_from(buffer, curpos)
+            if curpos + 12 + pathlen > len(buffer):
+                raise WAKDecryptError("ERROR: data.wak file table ends mid-path, try a different value for -m")
+            self.offsets.append(offset)
+            self.sizes.append(size)
+            self.pathlens.append(pathlen)
+            path_blob += buffer[curpos+12:curpos+12+pathlen]
+            path_blob += b"\x00"
             curpos += 12+pathlen
-            curidx += 1
+
+        # decode every path in one go, garbage paths mean the table didn't decrypt
+        try:
+            self.paths = path_blob.decode().split("\x00")[:-1]
+        except UnicodeDecodeError as err:
+            raise WAKDecryptError("ERROR: data.wak file table paths aren't utf-8, try a different value for -m") from err
+        if len(self.paths) != len(self.offsets):
+            raise WAKDecryptError("ERROR: data.wak file table seems corrupt, try a different value for -m")
+        self.path_index = {path: idx for idx, path in enumerate(self.paths)}
 
     def __len__(self):
-        return len(self.files)
+        return len(self.offsets)
 
     def __iter__(self):
-        return self
-    
-    def __next__(self):
-        self.num += 1
-        if self.num > len(self.files):
-            self.num = 0
-            raise StopIteration
-        return self.files[self.num-1]
+        for idx in range(len(self.offsets)):
+            yield self.WAKFile(self.paths[idx], self.offsets[idx], self.sizes[idx], self.pathlens[idx], idx)
+
+    def __contains__(self, path):
+        return path in self.path_index
+
+    def __getitem__(self, key):
+        idx = key
+        if isinstance(key, str):
+            idx = self.path_index[key]
+        elif idx < 0:
+            idx += len(self.offsets)
+        return self.WAKFile(self.paths[idx], self.offsets[idx], self.sizes[idx], self.pathlens[idx], idx)
+
+    def index(self, path):
+        return self.path_index[path]
 
+    def get(self, path, default=None):
+        if path not in self.path_index:
+            return default
+        return self[path]
+
+    # entries matching any include glob or regex (everything if there are none) and no exclude glob
+    def select(self, include=(), exclude=(), regexes=()):
+        include = [glob_to_regex(g) for g in include] + [re.compile(r) for r in regexes]
+        exclude = [glob_to_regex(g) for g in exclude]
+        for f in self:
+            if len(include) > 0 and not any(r.match(f.path) for r in include):
+                continue
+            if any(r.match(f.path) for r in exclude):
+                continue
+            yield f
+
+# read-only view of one entry, only the requested range gets decrypted.
+# CTR is seekable, block n of an entry is just the entry's IV + n.
+class WAKEntryFile(io.RawIOBase):
+    def __init__(self, wak, f, f_iv):
+        self.wak = wak
+        self.entry = f
+        self.name = f.path
+        self.iv = int.from_bytes(f_iv, "big")
+        self.pos = 0
+        # the last cipher we used and where it stopped, sequential reads keep going with it
+        self.cipher = None
+        self.cipher_pos = -1
+
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.entry.size + offset
+        else:
+            raise ValueError("invalid whence ({}, should be 0, 1 or 2)".format(whence))
+        if pos < 0:
+            raise ValueError("negative seek position {}".format(pos))
+        self.pos = pos
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.entry.size - self.pos)
+        if n <= 0:
+            return 0
+
+        start = self.pos
+        if self.cipher is None or self.cipher_pos != self.pos:
+            # rewind to the start of the block we land in, decrypt and drop the bytes before pos
+            start = self.pos - (self.pos % 16)
+            iv = ((self.iv + start//16) % (1 << 128)).to_bytes(16, "big")
+            self.cipher = self.wak.crypto.ctr_cipher(self.wak.prng.default_key, iv)
+
+        fdata = self.wak.datawak_contents[self.entry.offset+start:self.entry.offset+self.pos+n]
+        b[:n] = self.cipher.decrypt(fdata)[self.pos-start:]
+        self.pos += n
+        self.cipher_pos = self.pos
+        return n
+
+# wak = WAKParser("data.wak", ver) # mmaps the file, entries are memoryviews into it
+# wak = WAKParser(buffer, ver)     # or hand it the whole file as bytes
 class WAKParser():
     def __init__(self, buffer, ver):
         self.prng = BadPRNG(ver)
+        self.crypto = get_backend()
+        self.datawak_path = None
+        self.datawak_mmap = None
+        if isinstance(buffer, (str, Path)):
+            self.datawak_path = Path(buffer)
+            with open(self.datawak_path, 'rb') as f:
+                self.datawak_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(self.datawak_mmap)
         self.datawak_contents = buffer
-        self.datawak_head = AES.new(self.prng.default_key, AES.MODE_OFB, self.prng.bytes_iv_one).decrypt(self.datawak_contents[0:16])
+
+        try:
+            self.parse_header()
+        except:
+            self.close()
+            raise
+
+    def parse_header(self):
+        if len(self.datawak_contents) < 16:
+            raise WAKDecryptError("ERROR: data.wak is {} bytes, too short for a header".format(len(self.datawak_contents)))
+        self.datawak_head = self.crypto.ofb(self.prng.default_key, self.prng.bytes_iv_one, self.datawak_contents[0:16])
         self.datawak_head_length = struct.unpack("I", self.datawak_head[8:8+4])[0]
 
-        if self.datawak_head[0:4] != b"\x00\x00\x00\x00":
-            raise ValueError("ERROR: data.wak header seems incorrect, try a different value for -m")
+        if self.datawak_head[0:4] != b"\x00\x00\x00\x00" or self.datawak_head_length < 16 \
+                or self.datawak_head_length > len(self.datawak_contents):
+            raise WAKDecryptError("ERROR: data.wak header seems incorrect, try a different value for -m")
 
-        c = Counter.new(128, initial_value=bytes_to_long(self.prng.bytes_iv_negone))
-        first_buffer = AES.new(self.prng.default_key, AES.MODE_CTR, counter=c).decrypt(self.datawak_contents[16:self.datawak_head_length])
+        first_buffer = self.crypto.ctr(self.prng.default_key, self.prng.bytes_iv_negone, self.datawak_contents[16:self.datawak_head_length])
         self.file_list = WAKFileList(first_buffer)
+
+        # every entry has to be inside the file, or reading it later fails somewhere far less obvious
+        if len(self.file_list) > 0:
+            ends = np.frombuffer(self.file_list.offsets, dtype=np.uint32).astype(np.uint64) + \
+                np.frombuffer(self.file_list.sizes, dtype=np.uint32)
+            if int(ends.max()) > len(self.datawak_contents):
+                raise WAKDecryptError("ERROR: data.wak file table has entries past the end of the file, try a different value for -m")
+
+    # raw ciphertext of an entry, a zero-copy memoryview when we're mmapped
+    def entry_data(self, f):
+        return self.datawak_contents[f.offset:f.offset+f.size]
+
+    # every entry's IV in one go, row n is the IV for tblidx n
+    def entry_ivs(self):
+        return self.prng.badprng_get16_many(0x165EC8F + np.arange(len(self.file_list)))
+
+    def decrypt_entry(self, f, f_iv=None):
+        if f_iv is None:
+            f_iv = self.prng.badprng_get16(0x165EC8F+f.tblidx)
+        return self.crypto.ctr(self.prng.default_key, f_iv, self.entry_data(f))
+
+    # (entry, plaintext bytes) for entries in order, small entries share their cipher setup through ctr_iter.
+    # ivs are the entries' rows of entry_ivs() if you already have them.
+    def decrypt_entries(self, entries, ivs=None):
+        entries = list(entries)
+        if ivs is None:
+            ivs = self.prng.badprng_get16_many([0x165EC8F+f.tblidx for f in entries])
+        items = ((f_iv, self.entry_data(f)) for f, f_iv in zip(entries, ivs))
+        return zip(entries, self.crypto.ctr_iter(self.prng.default_key, items))
+
+    def exists(self, path):
+        return path in self.file_list
+
+    # f = wak.open("data/scripts/init.lua"), a seekable read-only binary file
+    def open(self, path):
+        f = self.file_list.get(path)
+        if f is None:
+            raise WAKNotFoundError("{} is not in this wak".format(path))
+        return io.BufferedReader(WAKEntryFile(self, f, self.prng.badprng_get16(0x165EC8F+f.tblidx)))
+
+    def read_bytes(self, path):
+        f = self.file_list.get(path)
+        if f is None:
+            raise WAKNotFoundError("{} is not in this wak".format(path))
+        return self.decrypt_entry(f)
+
+    # (entry, memoryview of its plaintext) for entries (default: all), decrypted as you go.
+    # prefetch > 0 keeps that many entries decrypting ahead of you on a thread pool.
+    def iter_entries(self, entries=None, prefetch=0):
+        entries = self.file_list if entries is None else entries
+        if prefetch <= 0:
+            for f, fdata_dec in self.decrypt_entries(entries):
+                yield f, memoryview(fdata_dec)
+            return
+
+        entries = list(entries)
+        ivs = self.prng.badprng_get16_many([0x165EC8F+f.tblidx for f in entries])
+        with ThreadPoolExecutor(min(prefetch, os.cpu_count() or 1)) as pool:
+            pending = deque()
+            for f, f_iv in zip(entries, ivs):
+                pending.append((f, pool.submit(self.decrypt_entry, f, f_iv.tobytes())))
+                if len(pending) > prefetch:
+                    f_done, result = pending.popleft()
+                    yield f_done, memoryview(result.result())
+            while len(pending) > 0:
+                f_done, result = pending.popleft()
+                yield f_done, memoryview(result.result())
+
+    def close(self):
+        if self.datawak_mmap is None:
+            return
+        try:
+            self.datawak_contents.release()
+            self.datawak_mmap.close()
+        except BufferError:
+            # someone still holds an entry view, the mmap goes away with the last of them
+            pass
+        self.datawak_mmap = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+
+# versions that decrypt the 16 byte header and the first file table entry, newest first.
+# read(offset, size) -> bytes, only a few dozen bytes get read no matter how big the wak is.
+def probe_wak_reader(read, total_size):
+    result = []
+    crypto = get_backend()
+    for ver in sorted(noita_versions.values(), reverse=True):
+        prng = BadPRNG(ver)
+        head = crypto.ofb(prng.default_key, prng.bytes_iv_one, read(0, 16))
+        if len(head) < 16 or head[0:4] != b"\x00\x00\x00\x00":
+            continue
+        head_length = struct.unpack("I", head[8:8+4])[0]
+        if head_length < 16 or head_length > total_size:
+            continue
+        if head_length == 16:
+            # empty table, nothing else to tell versions apart with
+            result.append(ver)
+            continue
+
+        cipher = crypto.ctr_cipher(prng.default_key, prng.bytes_iv_negone)
+        entry = cipher.decrypt(read(16, 12))
+        if len(entry) < 12:
+            continue
+        offset, size, pathlen = WAKFileList.entry_header.unpack(entry)
+        if pathlen == 0 or 16 + 12 + pathlen > head_length or offset < head_length or offset + size > total_size:
+            continue
+        try:
+            cipher.decrypt(read(16+12, pathlen)).decode()
+        except UnicodeDecodeError:
+            continue
+        result.append(ver)
+    return result
+
+def probe_wak_versions(path_or_buffer):
+    if isinstance(path_or_buffer, (str, Path)):
+        with open(path_or_buffer, 'rb') as f:
+            def read(offset, size):
+                f.seek(offset)
+                return f.read(size)
+            return probe_wak_reader(read, os.fstat(f.fileno()).st_size)
+    return probe_wak_reader(lambda offset, size: bytes(path_or_buffer[offset:offset+size]), len(path_or_buffer))
+
+# WAKParser for whichever PRNG version decrypts it. ver is tried first if given, otherwise we probe the header.
+def open_wak(path_or_buffer, ver=None):
+    if isinstance(path_or_buffer, (str, Path)) and not Path(path_or_buffer).is_file():
+        raise WAKNotFoundError("no data.wak at {}".format(path_or_buffer))
+    versions = probe_wak_versions(path_or_buffer)
+    if ver is not None:
+        versions = [ver] + [v for v in versions if v != ver]
+    for try_ver in versions:
+        try:
+            return WAKParser(path_or_buffer, try_ver)
+        except WAKDecryptError:
+            continue
+    raise WAKVersionError("couldn't decrypt {} with any of versions {}".format(
+        path_or_buffer if isinstance(path_or_buffer, (str, Path)) else "buffer", versions))
+
+# scrape registry if the user didn't tell us where their wak is
+def find_datawak_registry() -> Path:
+    import winreg
+    # (key, which half of the value has the path, wak locations relative to the parent of that path)
+    # if you've recently launched noita
+    # if you ever launched it from a random location, abuse the fact that the game is WOW64
+    # if you browsed to a folder with Noita in the name
+    locations = [
+        (r'Software\Classes\Local Settings\Software\Microsoft\Windows\Shell\MuiCache', 0, ["data/data.wak"]),
+        (r'Software\Microsoft\Windows NT\CurrentVersion\AppCompatFlags\Compatibility Assistant\Store', 0, ["data/data.wak"]),
+        (r'Software\Microsoft\Windows\CurrentVersion\Explorer\TypedPaths', 1, ["data/data.wak", "data.wak"])
+    ]
+    for key_path, val_idx, wak_paths in locations:
+        try:
+            key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, key_path, 0, winreg.KEY_READ)
+
+            for i in range(0, winreg.QueryInfoKey(key)[1]):
+                val = winreg.EnumValue(key, i)
+                if "noita" in val[val_idx].lower():
+                    noita_dir = Path(val[val_idx]).parent
+                    for p in wak_paths:
+                        if (noita_dir / p).is_file():
+                            return noita_dir / p
+        except (KeyboardInterrupt):
+            raise
+        except:
+            pass
+
+    return None
+
+def find_datawak():
+    test_paths = [
+        Path('data.wak'),
+        Path('data/data.wak'),
+        Path(r'C:\Program Files (x86)\Steam\steamapps\common\Noita\data\data.wak'),
+        Path.home() / '.local/share/Steam/steamapps/common/Noita/data/data.wak'
+    ]
+    for path in test_paths:
+        if path.is_file():
+            return path
+
+    if os.name == 'nt':
+        path = find_datawak_registry()
+        if path:
+            return path
+
+    raise WAKNotFoundError("couldn't find data.wak in default locations: {}".format(test_paths))
+
+# runs in a worker process for WAKWriter(jobs > 1), task is (key, iv, path)
+def encrypt_file(task):
+    key, f_iv, path = task
+    with open(path, 'rb') as f:
+        return get_backend().ctr(key, f_iv, f.read())
+
+# writer = WAKWriter(ver)
+# writer.write("data.wak", [("data/scripts/init.lua", b"..."), ("data/entities/x.xml", Path("x.xml"))])
+# writer.write("data.wak", WAKWriter.entries_from_dir("datawak_extracted"))
+# Paths are streamed from disk when the archive is written, bytes get spooled to a temp file,
+# so the whole archive never has to be in memory.
+class WAKWriter():
+    chunk_size = 1024*1024
+    # files up to this size get encrypted in the worker pool, anything bigger is streamed by us
+    parallel_max_size = 16*1024*1024
+
+    def __init__(self, ver, jobs=1):
+        self.prng = BadPRNG(ver)
+        self.jobs = jobs
+
+    @staticmethod
+    def entries_from_dir(root, skip=()):
+        root = Path(root)
+        for p in sorted(root.rglob("*")):
+            if p.is_file() and p.name not in skip:
+                yield (p.relative_to(root).as_posix(), p)
+
+    def copy_encrypted(self, out, cipher, src, size):
+        while size > 0:
+            chunk = src.read(min(self.chunk_size, size))
+            if len(chunk) == 0:
+                raise ValueError("source for wak entry ended {} bytes early".format(size))
+            out.write(cipher.encrypt(chunk))
+            size -= len(chunk)
+
+    def write(self, out_path, entries):
+        # [(path bytes, size, Path or offset into the spool)]
+        table = []
+        spool = None
+        try:
+            for path, src in entries:
+                if isinstance(src, Path):
+                    table.append((path.encode(), src.stat().st_size, src))
+                else:
+                    if spool is None:
+                        spool = tempfile.TemporaryFile()
+                    table.append((path.encode(), len(src), spool.tell()))
+                    spool.write(src)
+            self.write_table(out_path, table, spool)
+        finally:
+            if spool is not None:
+                spool.close()
+        return len(table)
+
+    def write_table(self, out_path, table, spool):
+        head_length = 16 + sum(12 + len(path_bytes) for path_bytes, size, src in table)
+        table_buffer = bytearray()
+        offset = head_length
+        for path_bytes, size, src in table:
+            table_buffer += WAKFileList.entry_header.pack(offset, size, len(path_bytes)) + path_bytes
+            offset += size
+        if offset > 0xFFFFFFFF:
+            raise ValueError("wak would be {} bytes, offsets are only 32 bits".format(offset))
+
+        key = self.prng.default_key
+        crypto = get_backend()
+        ivs = self.prng.badprng_get16_many(0x165EC8F + np.arange(len(table)))
+        head = struct.pack("IIII", 0, len(table), head_length, 0)
+
+        pool = None
+        # at most 2*jobs encrypted entries wait on us at a time, while we stream a big one the pool stops instead of
+        # piling the rest of the wak up in memory
+        in_flight = deque()
+        tasks = iter([(key, ivs[tblidx].tobytes(), src) for tblidx, (path_bytes, size, src) in enumerate(table)
+            if isinstance(src, Path) and size <= self.parallel_max_size])
+        def submit():
+            while pool is not None and len(in_flight) < 2*self.jobs:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                in_flight.append(pool.apply_async(encrypt_file, (task,)))
+        if self.jobs > 1:
+            pool = Pool(self.jobs)
+            submit()
+        try:
+            with open(out_path, 'wb') as out:
+                out.write(crypto.ofb(key, self.prng.bytes_iv_one, head))
+                out.write(crypto.ctr(key, self.prng.bytes_iv_negone, bytes(table_buffer)))
+
+                for tblidx, (path_bytes, size, src) in enumerate(table):
+                    if pool is not None and isinstance(src, Path) and size <= self.parallel_max_size:
+                        # in table order, same as they were submitted
+                        fdata_enc = in_flight.popleft().get()
+                        submit()
+                        if len(fdata_enc) != size:
+                            raise ValueError("{} changed size while writing the wak".format(src))
+                        out.write(fdata_enc)
+                        continue
+
+                    cipher = crypto.ctr_cipher(key, ivs[tblidx].tobytes())
+                    if isinstance(src, Path):
+                        with open(src, 'rb') as f:
+                            self.copy_encrypted(out, cipher, f, size)
+                    else:
+                        spool.seek(src)
+                        self.copy_encrypted(out, cipher, spool, size)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+# everything WAKWriter writes has to read back byte for byte, from bytes and from files, through the pool and
+# the streamed path for big entries
+def testwriter(jobs=4):
+    passed = True
+    rng = np.random.default_rng()
+    sizes = [0, 1, 15, 16, 17, 4095, 100000, 300000] + rng.integers(0, 70000, size=40).tolist()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        entries = []
+        for i, size in enumerate(sizes):
+            data = rng.integers(0, 256, size=size, dtype=np.uint8).tobytes()
+            if i % 2 == 0:
+                src = tmp / "src{}".format(i)
+                src.write_bytes(data)
+                entries.append(("data/d{}/f{}.bin".format(i % 5, i), src, data))
+            else:
+                entries.append(("data/d{}/f{}.bin".format(i % 5, i), data, data))
+        for ver in noita_versions.values():
+            for writer_jobs in (1, jobs):
+                writer = WAKWriter(ver, writer_jobs)
+                # small enough that the 100k/300k entries go through the streamed path
+                writer.parallel_max_size = 65536
+                out_path = tmp / "test_v{}_j{}.wak".format(ver, writer_jobs)
+                writer.write(out_path, [(path, src) for path, src, data in entries])
+                ok = True
+                with WAKParser(out_path, ver) as wak:
+                    ok = [f.path for f in wak.file_list] == [path for path, src, data in entries]
+                    for path, src, data in entries:
+                        if wak.read_bytes(path) != data:
+                            ok = False
+                            break
+                print("wak writer test {}: version {}, jobs {}, {} entries".format("passed" if ok else "failed", ver, writer_jobs, len(entries)))
+                passed = passed and ok
+    return passed
+
+if __name__ == "__main__":
+    sys.exit(0 if testwriter() else 1)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+import os, sys, shutil, hashlib, json, tempfile, argparse, stat
+from pathlib import Path
+
+
+# windows won't delete or rename over a read-only file, everything else will. blobs and their hardlinks are
+# read-only, and windows keeps that per file rather than per link, so the other links of path lose it too
+def remove_file(path):
+    try:
+        os.unlink(str(path))
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        os.chmod(str(path), stat.S_IWUSR | stat.S_IRUSR)
+        os.unlink(str(path))
+def replace_file(src, dst):
+    try:
+        os.replace(str(src), str(dst))
+    except PermissionError:
+        os.chmod(str(dst), stat.S_IWUSR | stat.S_IRUSR)
+        os.replace(str(src), str(dst))
+
+# content-addressed storage for extracted wak contents, every build is a manifest of path -> sha1
+# and each distinct file is only stored once no matter how many builds contain it.
+#
+# store = BlobStore("archive/blobstore")
+# digest = store.put(b"...") # or store.put_file(path)
+# store.save_manifest("881100_4336782_noitabeta", {"data/scripts/init.lua": digest})
+# store.materialize("881100_4336782_noitabeta", "some/dir") # hardlinks, copies if the fs can't link
+class BlobStore():
+    chunk_size = 1024*1024
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.manifest_dir = self.root / "manifests"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest):
+        return self.blob_dir / digest[0:2] / digest[2:]
+
+    def has(self, digest):
+        return self.blob_path(digest).is_file()
+
+    # write to a temp file next to the blob and rename it in, so concurrent writers of the same blob are fine
+    def add_blob(self, digest, write_fn):
+        blob_path = self.blob_path(digest)
+        if blob_path.is_file():
+            return digest
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(blob_path.parent), prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+            # blobs are shared through hardlinks, don't let anyone edit one in place
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            # another writer may have put the same blob in first
+            replace_file(tmp_path, blob_path)
+        except:
+            remove_file(tmp_path)
+            raise
+        return digest
+
+    # digest is the data's sha1 if the caller already has it
+    def put(self, data, digest=None):
+        if digest is None:
+            digest = hashlib.sha1(data).hexdigest()
+        return self.add_blob(digest, lambda f: f.write(data))
+
+    def put_file(self, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                h.update(chunk)
+        def copy_in(out):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, self.chunk_size)
+        return self.add_blob(h.hexdigest(), copy_in)
+
+    # put dest in place as a hardlink to the blob, or a copy across filesystems
+    def link(self, digest, dest):
+        dest = Path(dest)
+        blob_path = self.blob_path(digest)
+        if dest.exists():
+            if os.path.samefile(str(dest), str(blob_path)):
+                return
+            remove_file(dest)
+        elif not dest.parent.is_dir():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(str(blob_path), str(dest))
+        except OSError:
+            shutil.copyfile(str(blob_path), str(dest))
+
+    def manifest_path(self, name):
+        return self.manifest_dir / "{}.json".format(name)
+
+    def save_manifest(self, name, manifest):
+        manifest_path = self.manifest_path(name)
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=0, sort_keys=True)
+        os.replace(str(tmp_path), str(manifest_path))
+        return manifest_path
+
+    def load_manifest(self, name):
+        with open(self.manifest_path(name), 'r') as f:
+            return json.load(f)
+
+    def builds(self):
+        return sorted(p.stem for p in self.manifest_dir.glob("*.json"))
+
+    def materialize(self, name, out_dir):
+        out_dir = Path(out_dir)
+        manifest = self.load_manifest(name)
+        for path, digest in manifest.items():
+            self.link(digest, out_dir / path)
+        return len(manifest)
+
+    # file -> sha1 for everything under root, keyed by posix path relative to root
+    def put_tree(self, root):
+        root = Path(root)
+        manifest = {}
+        for p in root.rglob("*"):
+            if p.is_file():
+                manifest[p.relative_to(root).as_posix()] = self.put_file(p)
+        return manifest
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Content-addressed store of extracted wak contents.")
+    ap.add_argument('store', type=Path, help='Store folder. ex: archive/blobstore')
+    ap.add_argument('-l', dest='list', action='store_true', help='List the builds in the store.')
+    ap.add_argument('-b', dest='build', help='Build to materialize.')
+    ap.add_argument('-o', dest='outloc', type=Path, help='Folder to materialize the build into with hardlinks.')
+    args = ap.parse_args()
+
+    store = BlobStore(args.store)
+    if args.list or args.build is None:
+        for build in store.builds():
+            print(build)
+        sys.exit(0)
+    if args.outloc is None:
+        print("[:(] -o is required to materialize a build")
+        sys.exit(1)
+    print("[+] Materialized {} files from {} into {}".format(store.materialize(args.build, args.outloc), args.build, args.outloc))
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# data/translations/common.csv of every build, kept as columns (one per language) so lookups and "what changed in
+# this build" never have to parse the csv again.
+#
+#   python3 waktrans.py translations add 881100_4336782_noitabeta data.wak
+#   python3 waktrans.py translations get perk_vampirism -l en -l ru
+#   python3 waktrans.py translations changes 881100_4336782_noitabeta
+#
+# each build stores a delta against a base build: added/changed rows in full, and the removed keys. the base is the
+# last build added from the same branch (881100_<buildid>_<branch>) unless one is given, so "what changed" never
+# compares a beta build against public. every snapshot_every deltas along a chain also get a full copy, so getting at
+# an old build never applies more than that many.
+# files are npz, a text column is a utf-8 blob plus uint32 offsets, rows are sorted by key so the key column is the index.
+import sys, argparse, os, time, io, csv, json, hashlib, bisect
+from pathlib import Path
+
+import numpy as np
+
+from badprng import *
+from wakparsing import *
+from wakxml import LRUCache
+
+
+translations_path = "data/translations/common.csv"
+snapshot_every = 16
+
+# branch out of an archive folder name, 881100_4336782_noitabeta_mods -> noitabeta_mods. the whole name otherwise
+def build_branch(name):
+    parts = name.split("_", 2)
+    if len(parts) == 3 and parts[0].isdigit() and parts[1].isdigit():
+        return parts[2]
+    return name
+
+# (utf-8 blob, offsets) of a list of strings, and back
+def pack_strings(strings):
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def unpack_strings(blob, offsets):
+    blob = blob.tobytes()
+    return [blob[offsets[i]:offsets[i+1]].decode() for i in range(len(offsets) - 1)]
+
+# keys x languages, rows sorted by key. columns[lang index][row]
+class TranslationTable():
+    def __init__(self, keys, langs, columns):
+        self.keys = list(keys)
+        self.langs = list(langs)
+        self.columns = [list(c) for c in columns]
+
+    # first column is the key, every other named column is a language (the notes column too, it's just text).
+    # rows without a key are skipped, a key that shows up twice keeps its first row like the game does
+    @classmethod
+    def from_csv(cls, data):
+        rows = csv.reader(io.StringIO(data.decode("utf-8-sig", "replace"), newline=""))
+        header = next(rows, [])
+        lang_cols = [(i, name) for i, name in enumerate(header) if i > 0 and name.strip()]
+        table = {}
+        for row in rows:
+            if len(row) == 0 or not row[0].strip() or row[0] in table:
+                continue
+            table[row[0]] = [row[i] if i < len(row) else "" for i, name in lang_cols]
+        return cls.from_dict(table, [name for i, name in lang_cols])
+
+    # {key: [text per lang]}
+    @classmethod
+    def from_dict(cls, rows, langs):
+        keys = sorted(rows)
+        return cls(keys, langs, [[rows[k][l] for k in keys] for l in range(len(langs))])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    # text of key in lang, None if either isn't in this build
+    def get(self, key, lang="en"):
+        i = self.row(key)
+        if i is None or lang not in self.langs:
+            return None
+        return self.columns[self.langs.index(lang)][i]
+
+    # [text per lang] of key in the order of langs, "" for langs this table doesn't have
+    def values(self, key, langs=None):
+        i = self.row(key)
+        langs = self.langs if langs is None else langs
+        return [self.columns[self.langs.index(l)][i] if l in self.langs else "" for l in langs]
+
+    # (added, changed, removed) keys going from old to this one. a language being added or removed changes
+    # every row that had text in it
+    def diff(self, old):
+        langs = self.langs + [l for l in old.langs if l not in self.langs]
+        new_keys, old_keys = set(self.keys), set(old.keys)
+        added = sorted(new_keys - old_keys)
+        removed = sorted(old_keys - new_keys)
+        changed = [k for k in self.keys if k in old_keys and self.values(k, langs) != old.values(k, langs)]
+        return added, changed, removed
+
+    def to_arrays(self, prefix=""):
+        arrays = {prefix + "langs": np.array(self.langs, dtype=str)}
+        arrays[prefix + "keys"], arrays[prefix + "keys_off"] = pack_strings(self.keys)
+        for l, column in enumerate(self.columns):
+            arrays["{}col{}".format(prefix, l)], arrays["{}col{}_off".format(prefix, l)] = pack_strings(column)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=""):
+        langs = [str(l) for l in arrays[prefix + "langs"]]
+        keys = unpack_strings(arrays[prefix + "keys"], arrays[prefix + "keys_off"])
+        columns = [unpack_strings(arrays["{}col{}".format(prefix, l)], arrays["{}col{}_off".format(prefix, l)]) for l in range(len(langs))]
+        return cls(keys, langs, columns)
+
+# rows of new that old doesn't have or has different, plus the keys old had that new doesn't
+class TranslationDelta():
+    def __init__(self, rows, added, removed):
+        self.rows = rows
+        self.added = set(added)
+        self.removed = list(removed)
+
+    @classmethod
+    def between(cls, old, new):
+        added, changed, removed = new.diff(old)
+        keys = sorted(added + changed)
+        values = [new.values(k) for k in keys]
+        rows = TranslationTable(keys, new.langs, [[v[l] for v in values] for l in range(len(new.langs))])
+        return cls(rows, added, removed)
+
+    @property
+    def changed(self):
+        return [k for k in self.rows.keys if k not in self.added]
+
+    # old with this applied, rows take the delta's languages
+    def apply(self, old):
+        removed = set(self.removed)
+        rows = {k: old.values(k, self.rows.langs) for k in old.keys if k not in removed}
+        for i, k in enumerate(self.rows.keys):
+            rows[k] = [c[i] for c in self.rows.columns]
+        return TranslationTable.from_dict(rows, self.rows.langs)
+
+    def to_arrays(self):
+        arrays = self.rows.to_arrays("rows_")
+        arrays["added"] = np.array([k in self.added for k in self.rows.keys], dtype=bool)
+        arrays["removed"], arrays["removed_off"] = pack_strings(self.removed)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        rows = TranslationTable.from_arrays(arrays, "rows_")
+        added = [k for k, a in zip(rows.keys, arrays["added"]) if a]
+        return cls(rows, added, unpack_strings(arrays["removed"], arrays["removed_off"]))
+
+# store = TranslationStore("archive/translations")
+# store.add_build("881100_4336782_noitabeta", wak)
+# store.get("perk_vampirism", "en")            -> text in the latest build
+# store.changes("881100_4336782_noitabeta")    -> (added, changed, removed) keys against its base
+class TranslationStore():
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.store_dir / "index.json"
+        # [{"name", "base", "depth", "sha1", "rows", "snapshot"}] in the order builds were added. base is the build
+        # the delta is against (None for the first of a chain), depth how many deltas back the last snapshot is
+        self.index = []
+        if self.index_path.is_file():
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)["builds"]
+        self.cache = LRUCache(8)
+
+    def save_index(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"builds": self.index}, f, indent=1)
+        os.replace(str(tmp_path), str(self.index_path))
+
+    def save_arrays(self, path, arrays):
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(str(tmp_path), str(path))
+
+    def load_arrays(self, path):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    def builds(self):
+        return [b["name"] for b in self.index]
+
+    def has_build(self, name):
+        return name in self.builds()
+
+    def build_info(self, name):
+        for b in self.index:
+            if b["name"] == name:
+                return b
+        raise KeyError("{} isn't in {}".format(name, self.store_dir))
+
+    # last build added from name's branch, None if there isn't one
+    def branch_base(self, name):
+        branch = build_branch(name)
+        for b in reversed(self.index):
+            if build_branch(b["name"]) == branch:
+                return b["name"]
+        return None
+
+    # store common.csv of a WAKParser as build name, as a delta against base (the last build of its branch if None).
+    # returns (added, changed, removed) counts, None if it's already in. there's no replace, other builds' deltas
+    # can be against this one
+    def add_build(self, name, wak, base=None):
+        if self.has_build(name):
+            return None
+        base = self.branch_base(name) if base is None else base
+        data = wak.read_bytes(translations_path)
+        table = TranslationTable.from_csv(data)
+        if base is not None:
+            depth = self.build_info(base)["depth"] + 1
+            delta = TranslationDelta.between(self.table(base), table)
+        else:
+            depth = 0
+            delta = TranslationDelta.between(TranslationTable([], table.langs, [[] for l in table.langs]), table)
+
+        snapshot = depth % snapshot_every == 0
+        if snapshot:
+            depth = 0
+        self.save_arrays(self.store_dir / "{}.delta.npz".format(name), delta.to_arrays())
+        if snapshot:
+            self.save_arrays(self.store_dir / "{}.full.npz".format(name), table.to_arrays())
+        self.index.append({"name": name, "base": base, "depth": depth, "sha1": hashlib.sha1(data).hexdigest(),
+            "rows": len(table), "snapshot": snapshot})
+        self.save_index()
+        self.cache.put(name, table)
+        return len(delta.added), len(delta.changed), len(delta.removed)
+
+    def delta(self, name):
+        self.build_info(name)
+        return TranslationDelta.from_arrays(self.load_arrays(self.store_dir / "{}.delta.npz".format(name)))
+
+    # whole table of build name, from the closest snapshot along its bases plus the deltas after that
+    def table(self, name=None):
+        name = self.index[-1]["name"] if name is None else name
+        table = self.cache.get(name)
+        if table is not None:
+            return table
+        chain = [name]
+        while not self.build_info(chain[-1])["snapshot"]:
+            chain.append(self.build_info(chain[-1])["base"])
+        table = TranslationTable.from_arrays(self.load_arrays(self.store_dir / "{}.full.npz".format(chain[-1])))
+        for delta_name in reversed(chain[:-1]):
+            table = self.delta(delta_name).apply(table)
+        self.cache.put(name, table)
+        return table
+
+    # text of key in lang in build (the latest if None)
+    def get(self, key, lang="en", build=None):
+        return self.table(build).get(key, lang)
+
+    # build name's delta was taken against, None for the first build of a branch
+    def base(self, name):
+        return self.build_info(name)["base"]
+
+    # (added, changed, removed) keys of build against its base, straight out of its delta
+    def changes(self, name):
+        delta = self.delta(name)
+        return sorted(delta.added), delta.changed, delta.removed
+
+    # [(build, text in lang or None if removed)] for every build key was added, changed or removed in.
+    # branch limits it to builds of that branch
+    def history(self, key, lang="en", branch=None):
+        result = []
+        for name in self.builds():
+            if branch is not None and build_branch(name) != branch:
+                continue
+            delta = self.delta(name)
+            if key in delta.removed:
+                result.append((name, None))
+            elif delta.rows.row(key) is not None:
+                result.append((name, delta.rows.get(key, lang)))
+        return result
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Translation strings of every build, without parsing common.csv each time.")
+    ap.add_argument('store', type=Path, help='Folder the store lives in. ex: archive/translations')
+    sub = ap.add_subparsers(dest='command')
+    ap_add = sub.add_parser('add', help='Store a build\'s common.csv, as a delta against the last build of its branch.')
+    ap_add.add_argument('build', help='Name to store the build as. ex: 881100_4336782_noitabeta')
+    ap_add.add_argument('wak_file', type=Path, help='Path to the build\'s data.wak')
+    ap_add.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap_add.add_argument('--base', help='Build to store the delta against instead of the last one of the same branch.')
+    ap_get = sub.add_parser('get', help='Print the text of keys.')
+    ap_get.add_argument('keys', nargs='+', help='ex: perk_vampirism')
+    ap_get.add_argument('-b', dest='build', help='Build to look in, the latest if omitted.')
+    ap_get.add_argument('-l', dest='langs', action='append', default=[], help='Language column, can be repeated. en if omitted.')
+    ap_changes = sub.add_parser('changes', help='Keys added, changed and removed in a build.')
+    ap_changes.add_argument('build')
+    ap_changes.add_argument('-l', dest='lang', default='en', help='Language to print the new text in.')
+    ap_history = sub.add_parser('history', help='Every build a key changed in.')
+    ap_history.add_argument('key')
+    ap_history.add_argument('-l', dest='lang', default='en')
+    ap_history.add_argument('--branch', help='Only builds of this branch. ex: noitabeta')
+    sub.add_parser('builds', help='List stored builds.')
+    args = ap.parse_args()
+
+    store = TranslationStore(args.store)
+    if args.command == 'add':
+        try:
+            with open_wak(args.wak_file, args.noita_version) as wak:
+                time_start = time.time()
+                counts = store.add_build(args.build, wak, args.base)
+        except WAKError as err:
+            print("[:(] {}".format(err))
+            sys.exit(1)
+        if counts is None:
+            print("[?] {} is already stored".format(args.build))
+        else:
+            print("[+] Stored {} against {}: {} added, {} changed, {} removed, {:.2f}s".format(
+                args.build, store.base(args.build), *counts, time.time() - time_start))
+    elif args.command == 'get':
+        table = store.table(args.build)
+        for key in args.keys:
+            for lang in args.langs or ["en"]:
+                print("{} {}: {}".format(key, lang, table.get(key, lang)))
+    elif args.command == 'changes':
+        added, changed, removed = store.changes(args.build)
+        table = store.table(args.build)
+        print("[+] {} against {}".format(args.build, store.base(args.build) or "nothing, first of its branch"), file=sys.stderr)
+        for key in added:
+            print("A {}: {}".format(key, table.get(key, args.lang)))
+        for key in changed:
+            print("M {}: {}".format(key, table.get(key, args.lang)))
+        for key in removed:
+            print("D {}".format(key))
+    elif args.command == 'history':
+        for build, text in store.history(args.key, args.lang, args.branch):
+            print("{} {}".format(build, "(removed)" if text is None else text))
+    else:
+        for build in store.builds():
+            print(build)
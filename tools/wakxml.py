@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# 3.7.4 64-bit
+# resolve entity xml <Base file="..."> inheritance straight out of a wak, memoized per (build, path).
+#
+#   resolver = XMLResolver(wak, "881100_4336782_noitabeta")
+#   resolver.resolve("data/entities/animals/zombie.xml")   # merged Element, every Base pulled in. don't modify it
+#   resolver.build_dependency_index()
+#   resolver.dependents("data/entities/base_enemy_basic.xml")   # everything that has to be redone if it changes
+#   new_resolver.inherit(resolver, changed_paths)             # reuse every merged entity a build diff didn't touch
+#
+# merging works like the game does it: the base file's entity is loaded, components inside <Base> override the
+# attributes of the first base component with the same name, then the including entity's own components follow.
+# child entities of a base only come along with include_children="1". materials.xml's _parent chains are in
+# resolve_materials.
+import sys, argparse, time, re, copy
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from pathlib import Path
+
+from wakparsing import *
+
+
+# OrderedDict LRU, keys are (kind, build, path). get/put move a key to the back, the front gets evicted first
+class LRUCache():
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        return self.items.pop(key, None)
+
+    def keys(self):
+        return list(self.items.keys())
+
+    def __contains__(self, key):
+        return key in self.items
+    def __len__(self):
+        return len(self.items)
+
+# shared by every resolver that isn't given its own, so a second build's resolver can reuse the first's entries
+xml_cache = LRUCache()
+
+bare_amp_re = re.compile(rb"&(?!(?:[A-Za-z]+|#[0-9]+|#x[0-9A-Fa-f]+);)")
+
+# the game's parser lets a lot through that ElementTree doesn't, stray & and several top level elements are the usual ones
+def parse_xml(data):
+    try:
+        return ET.fromstring(data)
+    except ET.ParseError:
+        pass
+    data = bare_amp_re.sub(b"&amp;", data)
+    if data.startswith(b"<?xml"):
+        data = data[data.find(b"?>")+2:]
+    root = ET.fromstring(b"<_root>" + data + b"</_root>")
+    if len(root) == 1:
+        return root[0]
+    return root
+
+# components in <Base> set attributes on the first component of the same name, their children do the same one level down
+def apply_override(target, override):
+    for child in target:
+        if child.tag == override.tag:
+            child.attrib.update(override.attrib)
+            for sub in override:
+                apply_override(child, sub)
+            return
+    target.append(copy.deepcopy(override))
+
+class XMLResolver():
+    def __init__(self, wak, build, cache=None):
+        self.wak = wak
+        self.build = build
+        self.cache = xml_cache if cache is None else cache
+        # path -> files its <Base>s point at, and the other way around. filled by build_dependency_index
+        self.deps = {}
+        self.rdeps = {}
+        # (path, message) for files that didn't parse, missing bases and cycles
+        self.errors = []
+
+    # parsed, unmerged tree of path, None if it isn't in the wak or doesn't parse
+    def tree(self, path):
+        key = ("tree", self.build, path)
+        root = self.cache.get(key)
+        if root is not None:
+            return root
+        if not self.wak.exists(path):
+            self.errors.append((path, "not in the wak"))
+            return None
+        try:
+            root = parse_xml(self.wak.read_bytes(path))
+        except ET.ParseError as err:
+            self.errors.append((path, "doesn't parse: {}".format(err)))
+            return None
+        self.cache.put(key, root)
+        return root
+
+    # files the <Base> tags of path point at, including ones in nested child entities
+    def base_files(self, path):
+        root = self.tree(path)
+        if root is None:
+            return []
+        return [base.get("file") for base in root.iter("Base") if base.get("file")]
+
+    # merged Entity for path, with every Base pulled in. shared with the cache, so don't modify it
+    def resolve(self, path, stack=()):
+        key = ("entity", self.build, path)
+        merged = self.cache.get(key)
+        if merged is not None:
+            return merged
+        if path in stack:
+            self.errors.append((path, "includes itself through {}".format(" -> ".join(stack))))
+            return None
+        root = self.tree(path)
+        if root is None:
+            return None
+        merged = self.merge_entity(root, stack + (path,)) if root.tag == "Entity" else root
+        self.cache.put(key, merged)
+        return merged
+
+    def merge_entity(self, elem, stack):
+        result = ET.Element(elem.tag, dict(elem.attrib))
+        result.text = elem.text
+        for child in elem:
+            if child.tag == "Base":
+                base = self.resolve(child.get("file", ""), stack)
+                if base is None:
+                    continue
+                base = copy.deepcopy(base)
+                for override in child:
+                    apply_override(base, override)
+                for name, value in base.attrib.items():
+                    if name == "tags" and result.get("tags"):
+                        tags = result.get("tags").split(",")
+                        tags += [t for t in value.split(",") if t not in tags]
+                        result.set("tags", ",".join(tags))
+                    elif name not in result.attrib:
+                        result.set(name, value)
+                for base_child in base:
+                    if base_child.tag == "Entity" and child.get("include_children") != "1":
+                        continue
+                    result.append(base_child)
+            elif child.tag == "Entity":
+                result.append(self.merge_entity(child, stack))
+            else:
+                result.append(copy.deepcopy(child))
+        return result
+
+    # parse every xml under prefix and record who includes whom
+    def build_dependency_index(self, prefix="data/"):
+        self.deps, self.rdeps = {}, {}
+        for f in self.wak.file_list:
+            if f.path.startswith(prefix) and f.path.endswith(".xml"):
+                self.deps[f.path] = set(self.base_files(f.path))
+                for base in self.deps[f.path]:
+                    self.rdeps.setdefault(base, set()).add(f.path)
+        return len(self.deps)
+
+    # every file that includes path, directly or through other bases
+    def dependents(self, path):
+        result = set()
+        todo = [path]
+        while len(todo) > 0:
+            for dependent in self.rdeps.get(todo.pop(), ()):
+                if dependent not in result:
+                    result.add(dependent)
+                    todo.append(dependent)
+        return result
+
+    # drop path and everything built on top of it from the cache, returns the paths dropped
+    def invalidate(self, path):
+        dropped = {path} | self.dependents(path)
+        for p in dropped:
+            self.cache.pop(("entity", self.build, p))
+        self.cache.pop(("tree", self.build, path))
+        return dropped
+
+    # copy old's merged entities over to this build, except for changed paths and whatever depends on them.
+    # old needs its dependency index built. returns how many were reused
+    def inherit(self, old, changed_paths):
+        affected = set(changed_paths)
+        for p in changed_paths:
+            affected |= old.dependents(p)
+        reused = 0
+        for kind, build, path in self.cache.keys():
+            if build != old.build or path in affected:
+                continue
+            value = self.cache.get((kind, build, path))
+            if value is not None:
+                self.cache.put((kind, self.build, path), value)
+                reused += kind == "entity"
+        return reused
+
+    # {path: merged Entity} for every xml under prefix
+    def resolve_all(self, prefix="data/entities/"):
+        result = {}
+        for f in self.wak.file_list:
+            if f.path.startswith(prefix) and f.path.endswith(".xml"):
+                merged = self.resolve(f.path)
+                if merged is not None:
+                    result[f.path] = merged
+        return result
+
+    # {material name: merged CellData/CellDataChild}, children take their _parent's attributes and
+    # child elements unless they set their own
+    def resolve_materials(self, path="data/materials.xml"):
+        root = self.tree(path)
+        if root is None:
+            return {}
+        elems = {e.get("name"): e for e in root if e.tag in ("CellData", "CellDataChild") and e.get("name")}
+        result = {}
+        def merge(name, stack):
+            if name in result:
+                return result[name]
+            elem = elems[name]
+            parent = elem.get("_parent")
+            if parent is None or parent not in elems or parent in stack:
+                if parent is not None:
+                    self.errors.append((path, "material {} has a bad _parent {}".format(name, parent)))
+                result[name] = elem
+                return elem
+            merged = copy.deepcopy(merge(parent, stack + (name,)))
+            merged.tag = elem.tag
+            merged.attrib.update(elem.attrib)
+            for child in elem:
+                apply_override(merged, child)
+            result[name] = merged
+            return merged
+        for name in elems:
+            merge(name, ())
+        return result
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Resolve entity xml <Base> inheritance straight out of a data.wak.")
+    ap.add_argument('wak_file', type=Path, help='Path to your data.wak')
+    ap.add_argument('paths', nargs='*', help='Entity files to print merged. ex: data/entities/animals/zombie.xml')
+    ap.add_argument('-m', dest='noita_version', default=None, type=int, help='Version of noita. Worked out from the header if omitted or wrong.')
+    ap.add_argument('-a', dest='all', action='store_true', help='Resolve every entity and report how long it took.')
+    ap.add_argument('-d', dest='dependents', action='append', default=[], help='List every file that includes this one, directly or not.')
+    args = ap.parse_args()
+
+    try:
+        wak = open_wak(args.wak_file, args.noita_version)
+    except WAKError as err:
+        print("[:(] {}".format(err))
+        sys.exit(1)
+    with wak:
+        resolver = XMLResolver(wak, str(args.wak_file))
+        for path in args.paths:
+            merged = resolver.resolve(path)
+            if merged is not None:
+                print(ET.tostring(merged, encoding="unicode"))
+        if args.dependents:
+            resolver.build_dependency_index()
+            for path in args.dependents:
+                for dependent in sorted(resolver.dependents(path)):
+                    print(dependent)
+        if args.all:
+            time_start = time.time()
+            merged = resolver.resolve_all()
+            print("[+] Resolved {} entities in {:.2f}s".format(len(merged), time.time() - time_start))
+        for path, message in resolver.errors:
+            print("[?] {}: {}".format(path, message), file=sys.stderr)